@@ -0,0 +1,270 @@
+"""
+Benchmarks for the full divvycheck.py pipeline against a local mock server.
+
+Builds synthetic universes of dividend payers with options chains, serves them with
+divvyreplay.MockHTTPServer and runs every stage of a scan the same way __main__ does,
+reporting wall time, requests made and peak memory per stage.
+
+python benchmark.py
+python benchmark.py --universe large --allowed 120 --latency 0.05
+python benchmark.py --fixture scan.jsonl.gz
+"""
+
+import json
+import random
+import importlib
+import asyncio
+import argparse
+import logging
+import tracemalloc
+from time import perf_counter
+from datetime import date, timedelta
+from collections import OrderedDict
+#Pretty columns for CLI display. pip install columnar
+from columnar import columnar
+
+import divvycheck
+from divvyreplay import Fixture, MockHTTPServer, REPLAY_HOST
+
+_LOGGER = logging.getLogger()
+
+# constants
+BENCHMARK_PORT = 8767
+#Symbols, expirations per symbol and strikes per expiration.
+UNIVERSES = OrderedDict([
+    ('small', (50, 8, 20)),
+    ('medium', (500, 15, 40)),
+    ('large', (2000, 25, 60)),
+])
+FOREIGN_SHARE = 0.05 #Portion of symbols paying dividends in CAD.
+HALTED_SHARE = 0.02 #Portion of symbols Tradier quotes without an ask, at least one.
+UNLIMITED_RATELIMIT = 1000000
+
+
+class SyntheticMarket(object):
+    def __init__(self, symbols: int, expirations: int, strikes: int, seed: int = 0):
+        """
+        Deterministic fake market data in the same shape the IEX, Tradier and OCC apis return.
+        """
+        self.random = random.Random(seed)
+        self.symbols = self._symbols(symbols)
+        self.expirations = [(date.today() + timedelta(days=7 * (i + 1))).isoformat() for i in range(expirations)]
+        self.strikes = strikes
+        self.headers = {
+            'Content-Type': 'application/json',
+            'X-Ratelimit-Allowed': str(UNLIMITED_RATELIMIT),
+            'X-Ratelimit-Available': str(UNLIMITED_RATELIMIT)
+        }
+    
+    def _symbols(self, n: int) -> list:
+        symbols = []
+        for i in range(n):
+            symbol = ''
+            i += 26
+            while i:
+                i, letter = divmod(i, 26)
+                symbol = chr(65 + letter) + symbol
+            symbols.append(symbol)
+        
+        return symbols
+    
+    def _response(self, path: str, params: dict, body) -> dict:
+        return {'url': path, 'params': params, 'status': 200, 'headers': self.headers, 'body': json.dumps(body)}
+    
+    def _chain(self, symbol: str, expiration: str, price: float) -> list:
+        options = []
+        low = round(price * 0.8)
+        for i in range(self.strikes):
+            strike = low + i * 0.5
+            for option_type in ('put', 'call'):
+                intrinsic = max(strike - price, 0) if option_type == 'put' else max(price - strike, 0)
+                bid = round(intrinsic + self.random.uniform(0, 1.5), 2)
+                options.append({
+                    'symbol': '{0}{1}{2}{3:08d}'.format(symbol, expiration.replace('-', '')[2:], option_type[0].upper(), int(strike * 1000)),
+                    'description': '{0} {1} {2}'.format(symbol, expiration, option_type),
+                    'strike': strike,
+                    'option_type': option_type,
+                    'bid': bid,
+                    'ask': round(bid + self.random.uniform(0.01, 0.5), 2),
+                    'volume': self.random.randint(0, 500),
+                    'open_interest': self.random.randint(0, 5000),
+                    'contract_size': 100,
+                    'expiration_type': 'standard',
+                    'expiration_date': expiration,
+                    'root_symbol': symbol,
+                    'underlying': symbol
+                })
+        
+        return options
+    
+    def fixture(self) -> Fixture:
+        responses = []
+        divvies = []
+        record_date = (date.today() + timedelta(days=10)).isoformat()
+        ex_date = (date.today() + timedelta(days=9)).isoformat()
+        halted = set(self.random.sample(self.symbols, max(1, int(len(self.symbols) * HALTED_SHARE))))
+        
+        for symbol in self.symbols:
+            price = round(self.random.uniform(10, 200), 2)
+            foreign = self.random.random() < FOREIGN_SHARE
+            divvies.append({
+                'symbol': symbol,
+                'exDate': ex_date,
+                'recordDate': record_date,
+                'amount': round(price * self.random.uniform(0.002, 0.03), 4),
+                'currency': 'CAD' if foreign else 'USD'
+            })
+            
+            responses.append(self._response(
+                '/stable/stock/market/batch', {'format': 'json', 'symbols': symbol, 'types': 'quote'},
+                {symbol: {'quote': {'symbol': symbol, 'latestPrice': price, 'primaryExchange': 'NEW YORK STOCK EXCHANGE'}}}
+            ))
+            responses.append(self._response(
+                '/v1/markets/options/expirations', {'symbol': symbol, 'includeAllRoots': 'false', 'strikes': 'false'},
+                {'expirations': {'date': self.expirations}}
+            ))
+            responses.append(self._response(
+                '/v1/markets/quotes', {'symbols': symbol},
+                {'quotes': {'quote': {'symbol': symbol, 'bid': round(price - 0.01, 2), 'ask': None if symbol in halted else price, 'last': price}}}
+            ))
+            for expiration in self.expirations:
+                responses.append(self._response(
+                    '/v1/markets/options/chains', {'symbol': symbol, 'expiration': expiration, 'greeks': 'false'},
+                    {'options': {'option': self._chain(symbol, expiration, price)}}
+                ))
+        
+        responses.append(self._response('/v1/stock/market/upcoming-dividends', {'format': 'json'}, divvies))
+        responses.append(self._response('/stable/fx/latest', {'format': 'json', 'symbols': 'USDCAD'}, [{'symbol': 'USDCAD', 'rate': 1.35}]))
+        rss = '<?xml version="1.0"?><rss><channel>{0}</channel></rss>'.format(''.join(
+            '<item><title>Memo {0}</title><description>Option Symbol: {1} Date: {2}</description></item>'.format(i, symbol, ex_date)
+            for i, symbol in enumerate(self.random.sample(self.symbols, min(5, len(self.symbols))))
+        ))
+        responses.append({'url': '/infomemo-rss', 'params': {}, 'status': 200, 'headers': {'Content-Type': 'application/xml'}, 'body': rss})
+        
+        return Fixture(responses=responses)
+
+
+class Benchmark(object):
+    def __init__(self, server: MockHTTPServer, base_url: str):
+        self.server = server
+        self.base_url = base_url
+        self.results = []
+        self.engines = None
+    
+    def stage(self, name: str, func, *args, **kwargs):
+        """
+        Run a stage, recording wall time, requests served and peak memory.
+        """
+        requests_before = sum(self.server.request_counts.values())
+        bytes_before = self.server.bytes_sent
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        
+        started = perf_counter()
+        result = func(*args, **kwargs)
+        wall_time = perf_counter() - started
+        
+        self.results.append({
+            'stage': name,
+            'seconds': round(wall_time, 3),
+            'requests': sum(self.server.request_counts.values()) - requests_before,
+            'kb_received': round((self.server.bytes_sent - bytes_before) / 1024),
+            'peak_mb': round((tracemalloc.get_traced_memory()[1] - memory_before) / 1024 / 1024, 1)
+        })
+        
+        return result
+    
+    def run(self) -> list:
+        """
+        Run a whole scan the same way __main__ does, without any caching.
+        """
+        dd_obj = divvycheck.DivvyData('sk_benchmark')
+        opts_obj = divvycheck.OptionsData('Bearer benchmark')
+        calcs_obj = divvycheck.Calculations()
+        dd_obj.api = self.base_url + '{0}'
+        opts_obj.api = self.base_url + '{0}'
+        opts_obj.occ_url = self.base_url + '/infomemo-rss'
+        
+        #Stages should time their work, not the first use of a lazily imported library.
+        for module in (divvycheck.requests, divvycheck.aiohttp, divvycheck.np, divvycheck.orjson, divvycheck.ijson, divvycheck.tqdm):
+            dir(module)
+        importlib.import_module('bs4')
+        
+        tracemalloc.start()
+        try:
+            raw_divvy_data = self.stage('initial_divvy_query', dd_obj.initial_divvy_query)
+            quotes_dict = self.stage('grab_quotes', dd_obj.grab_quotes, raw_divvy_data)
+            divvies_with_exp = self.stage('grab_options_expirations', opts_obj.grab_options_expirations, quotes_dict=quotes_dict, raw_divvy_data=raw_divvy_data)
+            self.stage('cold_start', lambda: asyncio.run(divvycheck.ColdStart(dd_obj, opts_obj).run(raw_divvy_data, progress=False)))
+            divvies_with_options = self.stage(
+                'grab_all_options_data', lambda: asyncio.run(opts_obj.grab_all_options_data_async(divvies_with_exp, fetch_quotes=False))
+            )
+            divvies_with_yield = self.stage('currency_conversion', dd_obj.currency_conversion, divvies_with_options)
+            occmemos = self.stage('get_occ_memos', opts_obj.get_occ_memos)
+            self.stage('refresh_quotes', opts_obj.refresh_quotes, divvies_with_yield)
+            scalar_arbs = self.stage('find_arbs', calcs_obj.find_arbs, data=divvies_with_yield, occmemos=occmemos)
+            vectorized_arbs = self.stage('find_arbs_vectorized', calcs_obj.find_arbs_vectorized, data=divvies_with_yield, occmemos=occmemos)
+        finally:
+            tracemalloc.stop()
+        
+        self.engines = self.compare_engines(scalar_arbs, vectorized_arbs)
+        
+        return self.results
+    
+    def compare_engines(self, scalar_arbs: dict, vectorized_arbs: dict) -> dict:
+        """
+        The vectorized engine has to find exactly the trades find_arbs does, including skipping the
+        symbols quoted without an ask. find_arbs leaves an empty entry for symbols with a zero yield,
+        those don't count as trades.
+        """
+        scalar_arbs = {k: v for k, v in scalar_arbs.items() if v}
+        seconds = {result['stage']: result['seconds'] for result in self.results}
+        
+        return {
+            'match': scalar_arbs == dict(vectorized_arbs),
+            'trades': len(scalar_arbs),
+            'mismatched': sorted(k for k in set(scalar_arbs) | set(vectorized_arbs) if scalar_arbs.get(k) != vectorized_arbs.get(k)),
+            'speedup': round(seconds['find_arbs'] / seconds['find_arbs_vectorized'], 1) if seconds['find_arbs_vectorized'] else None
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the divvycheck.py pipeline against a local mock server.')
+    parser.add_argument('--universe', choices=list(UNIVERSES.keys()), action='append', help='Synthetic universe to run, defaults to all of them.')
+    parser.add_argument('--fixture', help='Benchmark a fixture recorded with divvycheck.py --record-fixture instead.')
+    parser.add_argument('--allowed', type=int, help='Simulate a Tradier rate limit of this many calls per minute.')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds of delay the mock server adds to every request.')
+    parser.add_argument('--json', help='Also write the report to this file as json.')
+    args = parser.parse_args()
+    
+    logging.disable(logging.INFO)
+    
+    if args.fixture:
+        fixtures = [(args.fixture, Fixture(args.fixture))]
+    else:
+        fixtures = [(name, SyntheticMarket(*UNIVERSES[name]).fixture()) for name in (args.universe or UNIVERSES.keys())]
+    
+    report = {}
+    mismatched = False
+    for i, (name, fixture) in enumerate(fixtures):
+        server = MockHTTPServer(fixture, ratelimit_allowed=args.allowed, latency=args.latency)
+        base_url = server.start_in_thread(REPLAY_HOST, BENCHMARK_PORT + i)
+        benchmark = Benchmark(server, base_url)
+        report[name] = {'stages': benchmark.run(), 'engines': benchmark.engines}
+        
+        print('Universe: {0}'.format(name))
+        headers = list(report[name]['stages'][0].keys())
+        print(columnar([list(result.values()) for result in report[name]['stages']], headers, no_borders=True, patterns=[]))
+        engines = benchmark.engines
+        if engines['match']:
+            print('find_arbs and find_arbs_vectorized agree on {0} trades, vectorized is {1}x faster.'.format(engines['trades'], engines['speedup']))
+        else:
+            mismatched = True
+            print('find_arbs and find_arbs_vectorized disagree on {0}'.format(', '.join(engines['mismatched'])))
+    
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    
+    if mismatched:
+        raise SystemExit(1)
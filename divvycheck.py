@@ -6,23 +6,85 @@ STOCK_QUOTE (underlying quote) = 1 per call
 FX_LATEST (currency converion list from tradeable divvies) = 500 per call
 """
 
-import requests
+from __future__ import annotations
+import asyncio
 import pickle
+import sqlite3
 import logging
 import re
+import argparse
+import json
+import csv
+import gzip
+import cProfile
+import pstats
+import heapq
+import itertools
+import random
+import zlib
+import sys
+import importlib.util
+from array import array
+from math import isnan, nan
 from pathlib import Path
 from typing import Callable, Generator
-from os import getcwd, path
-from time import sleep, strftime
-from datetime import datetime, date
-from decimal import Decimal
-from collections import OrderedDict, defaultdict
+from os import getcwd, listdir, path
+from time import sleep, strftime, time, monotonic
+from datetime import datetime, date, timedelta
+from email.utils import parsedate_to_datetime
+from decimal import Decimal, ROUND_FLOOR
+from collections import OrderedDict, defaultdict, namedtuple
+from functools import lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+
+
+def _lazy_import(name: str):
+    """
+    Import a module the first time one of its attributes is used. Heavy libraries are only
+    loaded by the stages that need them, so offline commands start fast.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named {0}, install it with pip.'.format(name))
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    
+    return module
+
+
+#Http calls. pip install requests
+requests = _lazy_import('requests')
+urllib3 = _lazy_import('urllib3')
 #For progress bar in CLI. pip install tqdm
-import tqdm
-#Pretty columns for CLI display. pip install columnar
-from columnar import columnar
-#Parsing rss xml feed. pip install lxml, pip install bs4
-from bs4 import BeautifulSoup as bbb
+tqdm = _lazy_import('tqdm')
+#Concurrent http requests for the options chain sweep. pip install aiohttp
+aiohttp = _lazy_import('aiohttp')
+#Vectorized arb calculations. pip install numpy
+np = _lazy_import('numpy')
+#Fast parsing of options chains. pip install orjson
+orjson = _lazy_import('orjson')
+#Streaming parse of the upcoming dividends list. pip install ijson
+ijson = _lazy_import('ijson')
+
+
+def columnar(data: list, headers: list, **kwargs) -> str:
+    #Pretty columns for CLI display. pip install columnar
+    from columnar import columnar as _columnar
+    from columnar.exceptions import TableOverflowError
+    try:
+        return _columnar(data, headers, **kwargs)
+    except TableOverflowError:
+        #Too many columns to wrap into the terminal, plain unwrapped columns are better than losing the results.
+        rows = [[str(header).upper() for header in headers]] + [[str(cell) for cell in row] for row in data]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(headers))]
+        return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
 
 _LOGGER = logging.getLogger()
 _LOGGER.setLevel(logging.INFO)
@@ -31,6 +93,251 @@ _LOGGER.setLevel(logging.INFO)
 OPTION_CONTRACT_COST = 1 #Assuming a one-lot contract, $1 minimum. Conservative estimate.
 CONTRACT_ACTIONS_PER_COLLAR = 4 #Number of contract actions required to manage a collar without pin risk.
 OPTION_CONTRACT_SIZE = 100
+CACHE_FILENAME = 'divvycheck-cache.sqlite'
+CACHE_MEMORY_ENTRIES = 4096 #Entries kept in the in memory tier.
+#Seconds each type of data stays cached.
+CACHE_TTL = {
+    'divvies': 24 * 60 * 60,
+    'divvies_with_exp': 24 * 60 * 60,
+    'quotes': 60 * 60, #IEX quotes are only used to calibrate the yield.
+    'fx': 10 * 60,
+    'expirations': 4 * 60 * 60,
+    'chains': 60,
+    'snapshot': 7 * 24 * 60 * 60,
+    'occ_memos': 365 * 24 * 60 * 60, #History of every memo seen, pruned by OCC_MEMO_HISTORY_DAYS.
+}
+TRADIER_STREAM_URL = 'wss://ws.tradier.com/v1/markets/events'
+WATCH_INTERVAL = 15 #Seconds between polls of the hot set in watch mode.
+WATCH_HEADROOM = Decimal(10) #Dollars. Watch mode keeps polling symbols whose best trade is within this of profitable.
+INCREMENTAL_HEADROOM = Decimal(25) #Dollars. Incremental scans skip symbols whose best trade lost more than this last scan.
+INCREMENTAL_RECHECK_AGE = 30 * 60 #Seconds. Skipped symbols are rechecked anyway once their last check is this old.
+INCREMENTAL_RECHECK_MOVE = Decimal('0.02') #Skipped symbols are also rechecked once the underlying moves this much since.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) #Seconds, upper bounds of the request latency histogram.
+STRIKE_KEY_SPAN = 10 ** 12 #Cents. Used to combine a symbol index and strike into one int64 key.
+MAX_CONCURRENT_REQUESTS = 10 #Tradier requests kept in flight at once during the chain sweep.
+TRADIER_RATELIMIT_ALLOWED = 120 #Market data calls per rate limit window. Replaced by the X-Ratelimit-Allowed header once seen.
+TRADIER_RATELIMIT_WINDOW = 60 #Seconds.
+MAX_RETRIES = 4 #Retries on 429 and 5xx responses.
+RETRY_BACKOFF = 0.5 #Seconds, doubled on each retry.
+CONNECT_TIMEOUT = 5 #Seconds to establish a connection.
+READ_TIMEOUT = 30 #Seconds to wait on a response. Large chains and the dividend list are slow.
+KEEPALIVE_TIMEOUT = 30 #Seconds idle pooled connections are kept open for.
+POOL_CONNECTIONS = 4 #Hosts: IEX, Tradier, OCC and a spare.
+POOL_MAXSIZE = MAX_CONCURRENT_REQUESTS #Pooled connections kept per host.
+
+#Request priorities, lower goes first. Realtime quotes before expirations before chains.
+#Chains get the position of the expiration added on so far dated chains go last.
+PRIORITY_QUOTE = 0
+PRIORITY_EXPIRATION = 1
+PRIORITY_CHAIN = 2
+
+IEX_QUOTE_BATCH_SIZE = 100 #Symbols per IEX batch quote call, the IEX limit.
+IEX_CONCURRENT_REQUESTS = 4 #IEX batch quote calls kept in flight during a cold start.
+QUOTE_BATCH_SIZE = 500 #Symbols per Tradier quotes call, sent as a POST body.
+EXPIRATION_WINDOW = 1 #Number of expirations on or after the record date to fetch chains for.
+OCC_SYMBOL_TAIL = re.compile(r'\d{6}[CP]\d{8}') #YYMMDD, call or put and the strike times 1000 on the end of every OSI symbol.
+NON_ROOT_CHARACTERS = re.compile('[^A-Z0-9]') #Share classes like BRK.B or BRK/B have options on the root BRKB.
+OCC_SYMBOL_CACHE_SIZE = 2 ** 16
+OCC_MEMO_SYMBOLS = re.compile(r'Symbols?:\s*([A-Z0-9./]+(?:\s*,\s*[A-Z0-9./]+)*)') #Option Symbol: ABC New Symbol: ABC1
+OCC_MEMO_DATES = re.compile(r'\d{1,2}/\d{1,2}/\d{2,4}|\d{4}-\d{2}-\d{2}|[A-Z][a-z]+ \d{1,2}, \d{4}')
+OCC_MEMO_DATE_FORMATS = ('%m/%d/%Y', '%m/%d/%y', '%Y-%m-%d', '%B %d, %Y', '%b %d, %Y')
+#Checked in order against the title and description, the first match is the adjustment type.
+OCC_MEMO_ADJUSTMENTS = (
+    ('special dividend', 'special_dividend'),
+    ('split', 'split'),
+    ('merger', 'merger'),
+    ('spin', 'spinoff'),
+    ('name change', 'name_change'),
+    ('symbol change', 'symbol_change'),
+    ('delist', 'delisting'),
+    ('adjust', 'adjustment'),
+)
+OCC_MEMO_LOOKBACK_DAYS = 7 #A memo stays relevant until this many days after its effective date, same as the rss window.
+OCC_MEMO_UNDATED_DAYS = 30 #Memos with no dates at all stay relevant for this many days after they were first seen.
+OCC_MEMO_HISTORY_DAYS = 365 #Memos older than this are dropped from the history.
+DIVVY_FIELDS = ('symbol', 'exDate', 'recordDate', 'amount', 'currency') #Fields of each upcoming dividend kept.
+RANK_TOP_K = 25 #Opportunities kept by rank_opportunities.
+SHARD_OUTPUT = 'divvycheck-shard-{0}-of-{1}.json' #Results of a --shard node, merged with --merge.
+HISTORY_DIRECTORY = 'divvycheck-history' #Parquet history of every scan run with --history.
+HISTORY_COMPRESSION = 'zstd'
+PIPELINE_BATCH_SIZE = 25 #Symbols evaluated together by the streaming pipeline, sharing one realtime quotes call.
+PIPELINE_BATCH_WAIT = 0.5 #Seconds a partial micro batch waits for more symbols before it's evaluated anyway.
+
+
+class Metrics(object):
+    def __init__(self):
+        """
+        Counters for every http call and pipeline stage of a run. Exported as a json run report
+        or in the Prometheus text format.
+        
+        throttle_seconds is wall clock time during which at least one request was held back by a
+        rate limiter, however many were waiting at once.
+        """
+        self.requests = defaultdict(lambda: {
+            'count': 0, 'errors': 0, 'retries': 0, 'bytes': 0, 'latency_sum': 0.0, 'latency_buckets': [0] * len(LATENCY_BUCKETS)
+        })
+        self.throttle_seconds = 0.0
+        self._throttled = 0
+        self._throttled_since = None
+        self.ratelimit_available = None
+        self.ratelimit_available_min = None
+        self.stages = OrderedDict()
+    
+    def _endpoint(self, url: str) -> tuple:
+        parsed = urlparse(url)
+        
+        return parsed.netloc, parsed.path
+    
+    def observe_request(self, url: str, status: int, seconds: float, size: int) -> None:
+        endpoint = self.requests[self._endpoint(url)]
+        endpoint['count'] += 1
+        endpoint['bytes'] += size
+        endpoint['latency_sum'] += seconds
+        if status != 200:
+            endpoint['errors'] += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                endpoint['latency_buckets'][i] += 1
+    
+    def observe_retry(self, url: str) -> None:
+        self.requests[self._endpoint(url)]['retries'] += 1
+    
+    def throttle_started(self) -> None:
+        """
+        A request started waiting on a rate limiter. Call throttle_ended once it's through.
+        """
+        if not self._throttled:
+            self._throttled_since = monotonic()
+        self._throttled += 1
+    
+    def throttle_ended(self) -> None:
+        self._throttled -= 1
+        if not self._throttled:
+            self.throttle_seconds += monotonic() - self._throttled_since
+    
+    def observe_ratelimit(self, available: int) -> None:
+        self.ratelimit_available = available
+        if self.ratelimit_available_min is None or available < self.ratelimit_available_min:
+            self.ratelimit_available_min = available
+    
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a pipeline stage. with _METRICS.stage('find_arbs'): ...
+        """
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + monotonic() - started
+    
+    @contextmanager
+    def profile(self, profiler: str = None, output_path: str = None):
+        """
+        Optionally profile a block with cProfile or pyinstrument. Stats are written to output_path,
+        or the top of them printed if there isn't one.
+        """
+        if profiler == 'cprofile':
+            cprofiler = cProfile.Profile()
+            cprofiler.enable()
+            try:
+                yield
+            finally:
+                cprofiler.disable()
+                if output_path:
+                    cprofiler.dump_stats(output_path)
+                else:
+                    pstats.Stats(cprofiler).sort_stats('cumulative').print_stats(25)
+        elif profiler == 'pyinstrument':
+            #Optional, only needed when asked for. pip install pyinstrument
+            from pyinstrument import Profiler
+            pyinstrumenter = Profiler()
+            pyinstrumenter.start()
+            try:
+                yield
+            finally:
+                pyinstrumenter.stop()
+                if output_path:
+                    with open(output_path, 'w') as f:
+                        f.write(pyinstrumenter.output_html())
+                else:
+                    print(pyinstrumenter.output_text())
+        else:
+            yield
+    
+    def merge(self, report: dict) -> None:
+        """
+        Fold in the request counters from another process' report, used to add up shards.
+        Stage timings are left out, the parent times the sharded stage as a whole.
+        """
+        for endpoint, v in report['requests'].items():
+            parsed = urlparse('//' + endpoint)
+            merged = self.requests[(parsed.netloc, parsed.path)]
+            for field in ('count', 'errors', 'retries', 'bytes', 'latency_sum'):
+                merged[field] += v[field]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                merged['latency_buckets'][i] += v['latency_buckets'][str(bound)]
+        #Shards are held back over the same stretch of time, adding them up would count it over again.
+        self.throttle_seconds = max(self.throttle_seconds, report['throttle_seconds'])
+        if report['ratelimit_available_min'] is not None:
+            self.observe_ratelimit(report['ratelimit_available_min'])
+        
+        return
+    
+    def report(self) -> dict:
+        return {
+            'stages': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            'requests': {
+                host + endpoint: dict(v, latency_buckets=dict(zip([str(bound) for bound in LATENCY_BUCKETS], v['latency_buckets'])))
+                for (host, endpoint), v in self.requests.items()
+            },
+            'throttle_seconds': round(self.throttle_seconds, 4),
+            'ratelimit_available': self.ratelimit_available,
+            'ratelimit_available_min': self.ratelimit_available_min
+        }
+    
+    def prometheus(self) -> str:
+        """
+        Prometheus text exposition format, for a node exporter textfile collector or a pushgateway.
+        """
+        lines = [
+            '# TYPE divvycheck_stage_seconds gauge',
+            *['divvycheck_stage_seconds{{stage="{0}"}} {1}'.format(name, seconds) for name, seconds in self.stages.items()],
+            '# TYPE divvycheck_request_seconds histogram',
+        ]
+        for (host, endpoint), v in self.requests.items():
+            labels = 'host="{0}",endpoint="{1}"'.format(host, endpoint)
+            for bound, count in zip(LATENCY_BUCKETS, v['latency_buckets']):
+                lines.append('divvycheck_request_seconds_bucket{{{0},le="{1}"}} {2}'.format(labels, bound, count))
+            lines.append('divvycheck_request_seconds_bucket{{{0},le="+Inf"}} {1}'.format(labels, v['count']))
+            lines.append('divvycheck_request_seconds_sum{{{0}}} {1}'.format(labels, v['latency_sum']))
+            lines.append('divvycheck_request_seconds_count{{{0}}} {1}'.format(labels, v['count']))
+        for metric, field in (('request_bytes_total', 'bytes'), ('request_errors_total', 'errors'), ('request_retries_total', 'retries')):
+            lines.append('# TYPE divvycheck_{0} counter'.format(metric))
+            for (host, endpoint), v in self.requests.items():
+                lines.append('divvycheck_{0}{{host="{1}",endpoint="{2}"}} {3}'.format(metric, host, endpoint, v[field]))
+        lines.append('# TYPE divvycheck_throttle_seconds_total counter')
+        lines.append('divvycheck_throttle_seconds_total {0}'.format(self.throttle_seconds))
+        if self.ratelimit_available is not None:
+            lines.append('# TYPE divvycheck_ratelimit_available gauge')
+            lines.append('divvycheck_ratelimit_available {0}'.format(self.ratelimit_available))
+            lines.append('# TYPE divvycheck_ratelimit_available_min gauge')
+            lines.append('divvycheck_ratelimit_available_min {0}'.format(self.ratelimit_available_min))
+        
+        return '\n'.join(lines) + '\n'
+    
+    def save(self, json_path: str = None, prometheus_path: str = None) -> None:
+        if json_path:
+            with open(json_path, 'w') as f:
+                json.dump(self.report(), f, indent=2)
+        if prometheus_path:
+            with open(prometheus_path, 'w') as f:
+                f.write(self.prometheus())
+        
+        return
+
+
+_METRICS = Metrics()
 
 
 class MissingAPIKeyException(Exception):
@@ -74,58 +381,489 @@ class APIKeys(object):
 
 
 class CachedData(object):
-    def __init__(self):
-        self.CACHED_DIVVIES_FILENAME = '{0}-divvies.pkl'.format(strftime('%d-%m-%y'))
+    def __init__(self, filename: str = CACHE_FILENAME, memory_entries: int = CACHE_MEMORY_ENTRIES):
+        """
+        Two tier cache. An in memory LRU sits over a sqlite file in the local directory, every
+        entry has its own TTL so each type of data can go stale at its own pace.
+        """
+        self.CACHED_DIVVIES_KEY = strftime('%d-%m-%y')
+        self.filepath = path.join(getcwd(), filename)
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._writes = 0
+        self._db = sqlite3.connect(self.filepath)
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value BLOB)')
+        self.purge()
+    
+    def _key(self, namespace: str, key: str) -> str:
+        return '{0}:{1}'.format(namespace, key)
+    
+    def _remember(self, cache_key: str, expires: float, value) -> None:
+        self._memory[cache_key] = (expires, value)
+        self._memory.move_to_end(cache_key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+    
+    def get(self, namespace: str, key: str, default=None):
+        """
+        Grab an entry, checking memory first and then disk. Expired entries count as missing.
+        """
+        cache_key = self._key(namespace, key)
+        if cache_key in self._memory:
+            expires, value = self._memory[cache_key]
+            if expires > time():
+                self._memory.move_to_end(cache_key)
+                return value
+            del self._memory[cache_key]
+        
+        row = self._db.execute('SELECT expires, value FROM cache WHERE key = ?', (cache_key,)).fetchone()
+        if row is None or row[0] <= time():
+            return default
+        
+        value = pickle.loads(row[1])
+        self._remember(cache_key, row[0], value)
+        
+        return value
+    
+    def set(self, namespace: str, key: str, value, ttl: float = None) -> None:
+        """
+        Store an entry in both tiers. TTL defaults to the one for the namespace in CACHE_TTL.
+        """
+        if ttl is None:
+            ttl = CACHE_TTL[namespace]
+        cache_key = self._key(namespace, key)
+        expires = time() + ttl
+        
+        self._remember(cache_key, expires, value)
+        self._db.execute(
+            'INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)',
+            (cache_key, expires, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        )
+        self._db.commit()
+        
+        #Every so often clear out stale entries so the file doesn't grow forever.
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self.purge()
+    
+    def fetch(self, namespace: str, key: str, fetch: Callable, ttl: float = None):
+        """
+        Grab an entry, or call fetch and cache what it returns if it's missing or stale.
+        """
+        value = self.get(namespace, key)
+        if value is None:
+            value = fetch()
+            self.set(namespace, key, value, ttl=ttl)
+        
+        return value
+    
+    def purge(self) -> None:
+        """
+        Delete expired entries from both tiers.
+        """
+        now = time()
+        for cache_key in [k for k, (expires, _) in self._memory.items() if expires <= now]:
+            del self._memory[cache_key]
+        self._db.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+        self._db.commit()
     
     def load(self) -> dict:
         """
         Load cached data so Dividend search, initial quotes, and expirations don't
         have to be loaded every single time since this information rarely changes.
         """
-        filepath = path.join(getcwd(), self.CACHED_DIVVIES_FILENAME)
-        if path.exists(filepath):
-            with open(filepath, 'rb') as f:
-                cache = pickle.load(f)
-        else:
-            cache = {}
-        
-        return cache
+        return self.get('divvies_with_exp', self.CACHED_DIVVIES_KEY, default={})
     
     def save(self, divvies_with_exp: dict) -> None:
         """
         Save cached data to hard disk to be reused later.
         """
-        filepath = path.join(getcwd(), self.CACHED_DIVVIES_FILENAME)
-        with open(filepath, 'wb') as f:
-            pickle.dump(divvies_with_exp, f)
+        self.set('divvies_with_exp', self.CACHED_DIVVIES_KEY, divvies_with_exp)
+        
+        return
+    
+    def save_last_scan(self, data: dict, current_arbs: dict) -> None:
+        """
+        Keep the chains, realtime quotes and yields the last scan calculated with, so rescore and show
+        can work offline. data is None when the chains weren't kept, like with --pipeline.
+        """
+        self.set('snapshot', 'last_scan_data', {
+            'scanned_at': datetime.now(),
+            'data': dict(data) if data is not None else None,
+            'arbs': dict(current_arbs)
+        })
+        
+        return
+    
+    def load_last_scan(self) -> dict:
+        """
+        Returns {'scanned_at': datetime, 'data': divvies_with_yield, 'arbs': current_arbs} or None.
+        """
+        return self.get('snapshot', 'last_scan_data')
+    
+    def load_snapshot(self) -> dict:
+        """
+        Load what the last scan saw, used by incremental scans to work out what changed.
+        
+        Returns a dictionary like {'divvies_with_exp': {...}, 'headroom': {'PSTX': {'profit': Decimal('-3.50'), ...}}},
+        see Calculations.headroom_entries.
+        """
+        return self.get('snapshot', 'last_scan', default={'divvies_with_exp': {}, 'headroom': {}})
+    
+    def save_snapshot(self, divvies_with_exp: dict, headroom: dict) -> None:
+        """
+        Save the symbols, expirations and headroom of this scan. Chains and realtime quotes are left
+        out, they're stale by the next scan anyway.
+        """
+        snapshot = {
+            'divvies_with_exp': {
+                k: {'quote': v['quote'], 'options_expirations': v['options_expirations'], 'divvy': v['divvy']}
+                for k, v in divvies_with_exp.items()
+            },
+            'headroom': headroom
+        }
+        self.set('snapshot', 'last_scan', snapshot)
         
         return
 
 
-class DivvyData(object):
-    def __init__(self, api_key: str):
-        self.api_key = api_key
+class SnapshotStore(object):
+    def __init__(self, directory: str = HISTORY_DIRECTORY):
+        """
+        History of every scan's dividends, realtime quotes and chains as compressed Parquet, one
+        dataset per table partitioned by scan date and symbol. Reads go a day at a time and only
+        touch the columns asked for, so months of scans never have to fit in memory at once.
+        
+        Optional, only needed when asked for. pip install pyarrow
+        """
+        self.directory = path.join(getcwd(), directory)
+    
+    def _schemas(self) -> dict:
+        import pyarrow as pa
+        
+        #Decimals are kept as strings so they come back exactly as they went in.
+        partition = [('date', pa.string()), ('symbol', pa.string()), ('scan', pa.string())]
+        return {
+            'dividends': pa.schema(partition + [
+                ('exDate', pa.string()),
+                ('recordDate', pa.string()),
+                ('amount', pa.string()),
+                ('currency', pa.string()),
+                ('options_expirations', pa.list_(pa.string())),
+                ('yield_usd', pa.string()),
+                ('yield_pct', pa.string())
+            ]),
+            'quotes': pa.schema(partition + [
+                ('bid', pa.float64()),
+                ('ask', pa.float64()),
+                ('last', pa.float64())
+            ]),
+            'chains': pa.schema(partition + [
+                ('expiration', pa.string()),
+                ('option_symbol', pa.string()),
+                ('is_put', pa.bool_()),
+                ('strike', pa.float64()),
+                ('bid', pa.float64()),
+                ('ask', pa.float64()),
+                ('volume', pa.int64())
+            ]),
+        }
+    
+    def append(self, data: dict, scanned_at: datetime = None) -> None:
+        """
+        Add a scan's divvies_with_yield to the history.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        
+        scanned_at = scanned_at or datetime.now()
+        scan_date = scanned_at.date().isoformat()
+        scan = scanned_at.isoformat(timespec='seconds')
+        schemas = self._schemas()
+        columns = {table: {field: [] for field in schema.names} for table, schema in schemas.items()}
+        
+        for k, v in data.items():
+            if 'div_yield' not in v:
+                continue
+            
+            for field, value in (
+                ('date', scan_date), ('symbol', k), ('scan', scan), ('exDate', v['divvy']['exDate']), ('recordDate', v['divvy']['recordDate']),
+                ('amount', str(v['divvy']['amount'])), ('currency', v['divvy']['currency']), ('options_expirations', list(v['options_expirations'])),
+                ('yield_usd', str(v['div_yield']['$'])), ('yield_pct', str(v['div_yield']['%']))
+            ):
+                columns['dividends'][field].append(value)
+            
+            if 'realtime_quote' in v:
+                for field, value in (('date', scan_date), ('symbol', k), ('scan', scan)):
+                    columns['quotes'][field].append(value)
+                for field in ('bid', 'ask', 'last'):
+                    columns['quotes'][field].append(v['realtime_quote'].get(field))
+            
+            for expiration, options_chain in v.get('options_data', {}).items():
+                n = len(options_chain)
+                for field, values in (
+                    ('date', [scan_date] * n), ('symbol', [k] * n), ('scan', [scan] * n), ('expiration', [expiration] * n),
+                    ('option_symbol', options_chain.symbols), ('is_put', [bool(is_put) for is_put in options_chain.is_put]),
+                    ('strike', options_chain.strike), ('bid', options_chain.bid), ('ask', options_chain.ask), ('volume', options_chain.volume)
+                ):
+                    columns['chains'][field].extend(values)
+        
+        partitioning = ds.partitioning(pa.schema([('date', pa.string()), ('symbol', pa.string())]), flavor='hive')
+        file_format = ds.ParquetFileFormat()
+        for table, schema in schemas.items():
+            if not columns[table]['symbol']:
+                continue
+            #Single threaded so rows keep their order, find_arbs picks the first of equally good strikes.
+            ds.write_dataset(
+                pa.table(columns[table], schema=schema), path.join(self.directory, table),
+                format=file_format, file_options=file_format.make_write_options(compression=HISTORY_COMPRESSION),
+                partitioning=partitioning, basename_template='scan-{0}-{{i}}.parquet'.format(scanned_at.strftime('%H%M%S')),
+                existing_data_behavior='overwrite_or_ignore', max_partitions=len(data) + 1, use_threads=False
+            )
+        
+        return
+    
+    def dates(self, since: str = None, until: str = None) -> list:
+        """
+        Scan dates in the history, oldest first. since and until are inclusive YYYY-MM-DD dates.
+        """
+        root = path.join(self.directory, 'dividends')
+        if not path.isdir(root):
+            return []
+        
+        scan_dates = sorted(name.split('=', 1)[1] for name in listdir(root) if name.startswith('date='))
+        return [d for d in scan_dates if (since is None or d >= since) and (until is None or d <= until)]
+    
+    def _read(self, table: str, scan_date: str, columns: list) -> dict:
+        import pyarrow.dataset as ds
+        
+        directory = path.join(self.directory, table, 'date={0}'.format(scan_date))
+        if not path.isdir(directory):
+            return {column: [] for column in columns}
+        
+        return ds.dataset(directory, format='parquet', partitioning='hive').to_table(columns=columns, use_threads=False).to_pydict()
+    
+    def scans(self, since: str = None, until: str = None) -> Generator:
+        """
+        Yield (scanned_at, data) for every scan in the history, oldest first. data is shaped like
+        divvies_with_yield with just what find_arbs needs.
+        """
+        for scan_date in self.dates(since, until):
+            scans = defaultdict(dict)
+            
+            dividends = self._read('dividends', scan_date, ['symbol', 'scan', 'exDate', 'recordDate', 'options_expirations', 'yield_usd', 'yield_pct'])
+            for symbol, scan, ex_date, record_date, options_expirations, yield_usd, yield_pct in zip(*dividends.values()):
+                scans[scan][symbol] = {
+                    'divvy': {'exDate': ex_date, 'recordDate': record_date},
+                    'options_expirations': options_expirations,
+                    'div_yield': {'$': Decimal(yield_usd), '%': Decimal(yield_pct)},
+                    'options_data': {}
+                }
+            
+            quotes = self._read('quotes', scan_date, ['symbol', 'scan', 'bid', 'ask', 'last'])
+            for symbol, scan, bid, ask, last in zip(*quotes.values()):
+                if symbol in scans[scan]:
+                    scans[scan][symbol]['realtime_quote'] = {'bid': bid, 'ask': ask, 'last': last}
+            
+            chains = self._read('chains', scan_date, ['symbol', 'scan', 'expiration', 'option_symbol', 'is_put', 'strike', 'bid', 'ask', 'volume'])
+            for symbol, scan, expiration, option_symbol, is_put, strike, bid, ask, volume in zip(*chains.values()):
+                if symbol not in scans[scan]:
+                    continue
+                options_data = scans[scan][symbol]['options_data']
+                if expiration not in options_data:
+                    options_data[expiration] = OptionChain(expiration)
+                options_data[expiration].append({
+                    'symbol': option_symbol, 'option_type': 'put' if is_put else 'call', 'strike': strike, 'bid': bid, 'ask': ask, 'volume': volume
+                })
+            
+            for scan in sorted(scans.keys()):
+                yield datetime.fromisoformat(scan), {k: scans[scan][k] for k in sorted(scans[scan].keys())}
+
+
+class Recorder(object):
+    def __init__(self, filepath: str):
+        """
+        Captures raw api responses into a gzipped json lines fixture, one response per line.
+        The fixture can be served back with divvyreplay.py to rerun a scan offline.
+        """
+        self.filepath = filepath
+        self.responses = []
+    
+    def capture(self, url: str, params: dict, status: int, headers: dict, body: bytes) -> None:
+        """
+        Record a response. API tokens are dropped from the params so fixtures can be shared.
+        """
+        self.responses.append({
+            'url': url,
+            'params': {k: str(v) for k, v in sorted((params or {}).items()) if k != 'token'},
+            'status': status,
+            'headers': {k: v for k, v in headers.items() if k.lower().startswith('x-ratelimit') or k.lower() == 'content-type'},
+            'body': body.decode('utf-8')
+        })
+    
+    def save(self) -> None:
+        with gzip.open(self.filepath, 'wt', encoding='utf-8') as f:
+            for response in self.responses:
+                f.write(json.dumps(response) + '\n')
+        
+        _LOGGER.info('Recorded {0} responses to {1}.'.format(len(self.responses), self.filepath))
+        
+        return
+
+
+class HTTPTransport(object):
+    def __init__(self):
+        """
+        Persistent connections shared by every client, one requests session per host so
+        thousands of calls in a scan reuse the same TCP and TLS connections.
+        
+        Connection errors are retried by the adapter. IEX and OCC calls also retry 502, 503 and 504
+        there. Callers that retry through their own rate limiter, like OptionsData._request, pass
+        retry=False and get a session whose adapter doesn't retry at all.
+        """
+        self.sessions = {}
+        self.status_retry_hosts = {'cloud.iexapis.com', 'infomemo.theocc.com'}
+    
+    def _retry(self, host: str, retry: bool = True) -> urllib3.util.retry.Retry:
+        if not retry:
+            return urllib3.util.retry.Retry(total=0, read=False, raise_on_status=False)
+        
+        status_retries = MAX_RETRIES if host in self.status_retry_hosts else 0
+        return urllib3.util.retry.Retry(
+            total=MAX_RETRIES,
+            connect=MAX_RETRIES,
+            read=0,
+            status=status_retries,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=None,
+            backoff_factor=RETRY_BACKOFF,
+            raise_on_status=False
+        )
+    
+    def _session(self, url: str, retry: bool = True) -> requests.Session:
+        host = urlparse(url).netloc
+        if (host, retry) not in self.sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=self._retry(host, retry))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            self.sessions[(host, retry)] = session
+        
+        return self.sessions[(host, retry)]
+    
+    def request(self, method: str, url: str, retry: bool = True, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+        return self._session(url, retry).request(method, url, **kwargs)
+    
+    def get(self, url: str, params: dict = None, **kwargs) -> requests.Response:
+        return self.request('GET', url, params=params, **kwargs)
+    
+    def post(self, url: str, data: dict = None, **kwargs) -> requests.Response:
+        return self.request('POST', url, data=data, **kwargs)
+    
+    def client_session(self) -> aiohttp.ClientSession:
+        """
+        aiohttp session for the async sweep and streaming. Keeps connections alive between
+        requests and caches dns, gzip is negotiated by aiohttp itself.
+        
+        Bound to the running event loop, so one is opened per asyncio.run.
+        """
+        connector = aiohttp.TCPConnector(
+            limit=POOL_MAXSIZE * POOL_CONNECTIONS, limit_per_host=POOL_MAXSIZE, keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=300
+        )
+        timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+    
+    def close(self) -> None:
+        for session in self.sessions.values():
+            session.close()
+        self.sessions = {}
+
+
+_TRANSPORT = HTTPTransport()
+
+
+class APIClient(object):
+    """
+    Cache and recording helpers shared by the API clients. Subclasses set cache and recorder.
+    """
+    cache = None
+    recorder = None
+    
+    def _cached(self, namespace: str, key: str, fetch: Callable):
+        """
+        Consult the cache if there is one, otherwise just fetch.
+        """
+        if self.cache is None:
+            return fetch()
+        
+        return self.cache.fetch(namespace, key, fetch)
+    
+    def _record(self, r: requests.Response, params: dict, started: float, size: int = None) -> None:
+        """
+        Count the response in the metrics and hand it to the recorder if there is one.
+        Streamed responses pass the size read off the wire, their content is gone by then.
+        """
+        _METRICS.observe_request(r.url, r.status_code, monotonic() - started, len(r.content) if size is None else size)
+        if self.recorder is not None:
+            self.recorder.capture(r.url.split('?')[0], params, r.status_code, r.headers, r.content)
+    
+    async def _cached_async(self, namespace: str, key: str, fetch: Callable):
+        """
+        Async version of _cached, fetch is a coroutine function.
+        """
+        if self.cache is not None:
+            value = self.cache.get(namespace, key)
+            if value is not None:
+                return value
+        
+        value = await fetch()
+        if self.cache is not None:
+            self.cache.set(namespace, key, value)
         
+        return value
+
+
+class DivvyData(APIClient):
+    def __init__(self, api_key: str, cache: CachedData = None):
+        self.api_key = api_key
+        self.api = 'https://cloud.iexapis.com{0}'
+        self.cache = cache
+        self.session = _TRANSPORT
+        self.recorder = None
+    
     def initial_divvy_query(self) -> dict:
         """
-        Initial bulk query to find upcoming divvies. Costs a huge credit.
+        Initial bulk query to find upcoming divvies. Costs a huge credit, so it's cached for a day.
         
         Returns a dictionary with tickers as keys like {'PSTX': {'data...': 0}}
         """
+        return self._cached('divvies', 'upcoming', self._initial_divvy_query)
+    
+    def _initial_divvy_query(self) -> dict:
         _LOGGER.info('Querying IEX for upcoming dividends.')
         
+        #The recorder needs the whole body, otherwise it's parsed off the socket as it comes in.
+        stream = self.recorder is None
         try:
             params = {'token': self.api_key, 'format': 'json'}
-            r = requests.get('https://cloud.iexapis.com/v1/stock/market/upcoming-dividends', params=params)
-            stuff = r.json(parse_float=Decimal)
+            started = monotonic()
+            r = self.session.get(self.api.format('/v1/stock/market/upcoming-dividends'), params=params, stream=stream)
         except Exception as e:
             _LOGGER.error('Unable to query for upcoming dividends. {0}'.format(e))
         
         raw_divvy_data = {}
-        for item in stuff:
-            #In case stock has different classes, remove. I.e. 'CWEN.A' -> 'CWEN' This just causes problems later.
-            symbol = item['symbol'].split('.')[0]
-            raw_divvy_data[item['symbol']] = item
+        with r:
+            if stream:
+                #Undo the gzip as it's read, like r.content does.
+                r.raw.decode_content = True
+            #One record at a time, keeping only the fields used. Decimals like parse_float=Decimal.
+            for item in ijson.items(r.raw if stream else r.content, 'item'):
+                #In case stock has different classes, remove. I.e. 'CWEN.A' -> 'CWEN' This just causes problems later.
+                symbol = item['symbol'].split('.')[0]
+                raw_divvy_data[item['symbol']] = {field: item.get(field) for field in DIVVY_FIELDS}
+            self._record(r, params, started, size=r.raw.tell() if stream else None)
         
         return raw_divvy_data
     
@@ -162,11 +900,19 @@ class DivvyData(object):
         """
         _LOGGER.info('Querying IEX for stock quotes.')
         
-        symbols_list = list(raw_divvy_data.keys())
+        symbols_list = []
         quotes_output = []
         
+        #Only query for symbols that aren't cached.
+        for symbol in raw_divvy_data.keys():
+            cached = self.cache.get('quotes', symbol) if self.cache is not None else None
+            if cached is None:
+                symbols_list.append(symbol)
+            else:
+                quotes_output.append({symbol: cached})
+        
         #Batch requests by 100, the iex quote limit.
-        for item in tqdm.tqdm(self._chunks(lst=symbols_list, n=100)):
+        for item in tqdm.tqdm(self._chunks(lst=symbols_list, n=IEX_QUOTE_BATCH_SIZE)):
             params = {
                 'token': self.api_key,
                 'format': 'json',
@@ -175,21 +921,151 @@ class DivvyData(object):
             }
             
             try:
-                r = requests.get('https://cloud.iexapis.com/stable/stock/market/batch', params=params)
-                quotes_output.append(r.json(parse_float=Decimal))
+                started = monotonic()
+                r = self.session.get(self.api.format('/stable/stock/market/batch'), params=params)
+                self._record(r, params, started)
+                batch_output = r.json(parse_float=Decimal)
+                quotes_output.append(batch_output)
+                if self.cache is not None:
+                    for k, v in batch_output.items():
+                        self.cache.set('quotes', k, v)
             except Exception as e:
                 _LOGGER.error('Unable to query {0} for quotes. {1}'.format(item, e))
         
         return self._punt_otc(quotes_output)
     
-    def currency_conversion(self, divvies_with_options: dict) -> dict:
+    async def _request_async(self, session: aiohttp.ClientSession, endpoint: str, params: dict) -> dict:
+        """
+        Async IEX call, returns the json with Decimal floats. Retries connection errors and 502, 503
+        and 504 like the sync transport does.
+        """
+        url = self.api.format(endpoint)
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                started = monotonic()
+                async with session.get(url, params=params) as r:
+                    status = r.status
+                    body = await r.read()
+                    _METRICS.observe_request(url, status, monotonic() - started, len(body))
+                    if self.recorder is not None:
+                        self.recorder.capture(url, params, status, r.headers, body)
+                    if status == 200:
+                        return json.loads(body, parse_float=Decimal)
+                    elif status not in (502, 503, 504):
+                        raise Exception('Status code: {0}'.format(status))
+            except aiohttp.ClientConnectionError:
+                if attempt == MAX_RETRIES:
+                    raise
+                status = 'connection error'
+            
+            if attempt < MAX_RETRIES:
+                _METRICS.observe_retry(url)
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt * random.uniform(1, 1.5))
+        
+        raise Exception('Status code: {0}'.format(status))
+    
+    async def grab_quotes_async(self, session: aiohttp.ClientSession, raw_divvy_data: dict, quote_batches: asyncio.Queue, concurrency: int = IEX_CONCURRENT_REQUESTS) -> None:
+        """
+        Same as grab_quotes, but batches are fetched concurrently and each one is put on quote_batches
+        as soon as it's in, OTC symbols already punted. Cached quotes go first as one batch.
+        """
+        _LOGGER.info('Querying IEX for stock quotes.')
+        semaphore = asyncio.Semaphore(concurrency)
+        symbols_list = []
+        cached_output = {}
+        
+        #Only query for symbols that aren't cached.
+        for symbol in raw_divvy_data.keys():
+            cached = self.cache.get('quotes', symbol) if self.cache is not None else None
+            if cached is None:
+                symbols_list.append(symbol)
+            else:
+                cached_output[symbol] = cached
+        if cached_output:
+            await quote_batches.put(self._punt_otc([cached_output]))
+        
+        async def _batch(item: list) -> None:
+            params = {
+                'token': self.api_key,
+                'format': 'json',
+                'symbols': ','.join(item),
+                'types': 'quote'
+            }
+            try:
+                async with semaphore:
+                    batch_output = await self._request_async(session, '/stable/stock/market/batch', params)
+            except Exception as e:
+                _LOGGER.error('Unable to query {0} for quotes. {1}'.format(item, e))
+                return
+            if self.cache is not None:
+                for k, v in batch_output.items():
+                    self.cache.set('quotes', k, v)
+            await quote_batches.put(self._punt_otc([batch_output]))
+        
+        await asyncio.gather(*[_batch(item) for item in self._chunks(lst=symbols_list, n=IEX_QUOTE_BATCH_SIZE)])
+        
+        return
+    
+    def foreign_currencies(self, divvies: dict) -> set:
+        """
+        Currencies other than USD paid by these divvies.
+        """
+        return {v['divvy']['currency'] for v in divvies.values() if v['divvy']['currency'] not in ('USD', None, '')}
+    
+    def fx_rates(self, currencies) -> dict:
+        """
+        Latest exchange rates out of USD, keyed by currency. Rates are cached per currency so
+        repeated scans skip the round trip, anything missing is grabbed in one call.
+        """
+        rates = {}
+        missing = []
+        for currency in sorted(set(currencies)):
+            cached = self.cache.get('fx', currency) if self.cache is not None else None
+            if cached is None:
+                missing.append(currency)
+            else:
+                rates[currency] = cached
+        
+        if not missing:
+            return rates
+        
+        _LOGGER.info('Querying IEX for currency exchange rates.')
+        currency_pairs = ['USD{0}'.format(currency) for currency in missing]
+        r = None
+        currency_output = None
+        try:
+            params = {
+                'token': self.api_key,
+                'format': 'json',
+                'symbols': ','.join(currency_pairs)
+            }
+            started = monotonic()
+            r = self.session.get(self.api.format('/stable/fx/latest'), params=params)
+            self._record(r, params, started)
+            currency_output = r.json(parse_float=Decimal)
+            if r.status_code != 200:
+                raise Exception('Status code: {0}'.format(r.status_code))
+        except Exception as e:
+            raise Exception('Unable to query latest fx data. Status code: {0}. Input data: {1} Output data: {2} Error: {3}'.format(
+                r.status_code if r is not None else None, currency_pairs, currency_output, e
+            ))
+        
+        for item in currency_output:
+            currency = item['symbol'].replace('USD', '')
+            rates[currency] = Decimal(item['rate'])
+            if self.cache is not None:
+                self.cache.set('fx', currency, rates[currency])
+        
+        return rates
+    
+    def currency_conversion(self, divvies_with_options: dict, fx_rates: dict = None) -> dict:
         """
         Convert currencies. Divvies reported by IEX are in their local currency, but quotes
         for American traded symbols are in USD.
+        
+        fx_rates from fx_rates can be passed in, otherwise they're looked up for the currencies needed.
         """
-        _LOGGER.info('Querying IEX for currency exchange rates.')
-        currency_pairs = []
-        currency_conversion = defaultdict(dict)
+        currency_conversion = {}
         divvies_with_yield = defaultdict(dict)
         
         #Initial filtering for bad/no data from IEX.
@@ -197,122 +1073,546 @@ class DivvyData(object):
             currency_type = v['divvy']['currency']
             currency_amount = v['divvy']['amount']
             
-            if currency_type == 'USD':
-                if currency_amount != 0:
-                    divvies_with_yield[k] = v
-                    divvies_with_yield[k]['div_yield'] = {
-                        '%': round(Decimal(( Decimal(currency_amount) / Decimal(v['quote']['latestPrice']) ) * 100 ), 2),
-                        '$': currency_amount
-                    }
-            else:
-                if currency_amount != 0:
-                    if currency_type:
-                        currency_pairs.append('USD{0}'.format(currency_type))
-                        currency_conversion[k] = currency_type
-            
             if currency_amount == 0:
                 continue
+            
+            if currency_type == 'USD':
+                divvies_with_yield[k] = v
+                divvies_with_yield[k]['div_yield'] = {
+                    '%': round(Decimal(( Decimal(currency_amount) / Decimal(v['quote']['latestPrice']) ) * 100 ), 2),
+                    '$': currency_amount
+                }
+            elif currency_type:
+                currency_conversion[k] = currency_type
+        
+        if not currency_conversion:
+            return divvies_with_yield
         
-        #Once all non USD currency pairs are determined, query for the latest exchange rates.
-        if currency_pairs:
+        if fx_rates is None:
+            fx_rates = self.fx_rates(currency_conversion.values())
+        
+        #Fill in the yield using the exchange rate.
+        for k, currency_type in currency_conversion.items():
+            rate = fx_rates.get(currency_type)
+            if rate is None:
+                continue
+            v = divvies_with_options[k]
             try:
-                params = {
-                    'token': self.api_key,
-                    'format': 'json',
-                    'symbols': ','.join(set(currency_pairs))
+                divvies_with_yield[k] = v
+                divvies_with_yield[k]['div_yield'] = {
+                    '%': round(Decimal((( Decimal(v['divvy']['amount']) / rate ) / Decimal(v['quote']['latestPrice']) ) * 100 ), 2),
+                    '$': Decimal(v['divvy']['amount'])
                 }
-                r = requests.get('https://cloud.iexapis.com/stable/fx/latest', params=params)
-                currency_output = r.json(parse_float=Decimal)
-                if r.status_code != 200:
-                    raise Exception('Unable to query latest fx data.Status code: {0}. Input data: {1} Output data: {2}'.format(r.status_code, currency_pairs, currency_output))
             except Exception as e:
-                raise Exception('Unable to query latest fx data.Status code: {0}. Input data: {1} Output data: {2} Error: {3}'.format(r.status_code, currency_pairs, currency_output, e))
-            
-            #Fill in the yield using the exchange rate.
-            for k, v in currency_conversion.items():
-                for item in currency_output:
-                    try:
-                        currency_symbol = item['symbol'].replace('USD', '')
-                        if currency_symbol == v:
-                            divvies_with_yield[k] = divvies_with_options[k]
-                            divvies_with_yield[k]['div_yield'] = {
-                                '%': round(Decimal((( Decimal(divvies_with_options[k]['divvy']['amount']) / Decimal(item['rate']) ) / Decimal(divvies_with_options[k]['quote']['latestPrice']) ) * 100 ), 2),
-                                '$': Decimal(divvies_with_options[k]['divvy']['amount'])
-                            }
-                    except Exception as e:
-                        raise Exception('Unable to query convert currency on {0}. Data: {1} Error: {2}'.format(k, item, e))
+                raise Exception('Unable to query convert currency on {0}. Data: {1} Error: {2}'.format(k, rate, e))
         
         return divvies_with_yield
 
 
-class OptionsData(object):
-    def __init__(self, api_key: str):
-        self.headers = {"Accept": "application/json", "Authorization": api_key}
-        self.api = 'https://api.tradier.com{0}'
-        self.ratelimit_available = 120 #I think they say 120 calls/min?
-    
-    def throttle(self) -> None:
+class RateLimiter(object):
+    def __init__(self, allowed: int = TRADIER_RATELIMIT_ALLOWED, window: int = TRADIER_RATELIMIT_WINDOW, share: float = 1):
         """
-        Function to throttle requests when rate limit available starts getting low.
+        Token bucket kept in sync with the Tradier rate limit headers.
+        
+        The bucket refills continuously at the account allowance, and each response clamps it
+        down to X-Ratelimit-Available. Once the budget is exhausted requests are held until
+        X-Ratelimit-Expiry.
         
-        Easier than handling rate limits.
+        share is the portion of the account allowance this process gets, for shards using the same key.
+        """
+        self.share = share
+        allowed = max(int(allowed * share), 1)
+        self.allowed = allowed
+        self.window = window
+        self.tokens = float(allowed)
+        self.available = allowed
+        self.hold_until = 0
+        self._last_refill = monotonic()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._loop = None
+    
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(float(self.allowed), self.tokens + (now - self._last_refill) * self.allowed / self.window)
+        self._last_refill = now
+    
+    def delay(self) -> float:
+        """
+        Seconds until the next token is available.
         """
-        if self.ratelimit_available < 20:
-            sleep(1)
+        self._refill()
+        hold = self.hold_until - time()
+        if hold > 0:
+            return hold
+        if self.tokens >= 1:
+            return 0
         
-        return
+        return (1 - self.tokens) * self.window / self.allowed
     
-    def quotes(self, symbol: str) -> dict:
+    def update(self, headers: dict) -> None:
         """
-        Using the inputted quote, grab realtime prices. Used to calculate spreads.
+        Sync the bucket with the rate limit headers from a response.
         """
-        url = self.api.format('/v1/markets/quotes')
-        params = {'symbols': symbol}
         try:
-            r = requests.get(url, headers=self.headers, params=params)
-            self.ratelimit_available = int(r.headers['X-Ratelimit-Available'])
-            data = r.json()['quotes']['quote']
-            return r.json()['quotes']['quote']
-        except Exception as e:
-            raise Exception('Problem querying stock quotes. Status code: {0} Symbol: {1} Error: {2}'.format(r.status_code, symbol, e))
+            if 'X-Ratelimit-Allowed' in headers:
+                self.allowed = max(int(int(headers['X-Ratelimit-Allowed']) * self.share), 1)
+            if 'X-Ratelimit-Available' in headers:
+                self.available = int(headers['X-Ratelimit-Available'])
+                _METRICS.observe_ratelimit(self.available)
+                self._refill()
+                self.tokens = min(self.tokens, self.available * self.share)
+                if self.available <= 0 and 'X-Ratelimit-Expiry' in headers:
+                    #Expiry is epoch milliseconds.
+                    self.hold_until = int(headers['X-Ratelimit-Expiry']) / 1000
+        except ValueError as e:
+            _LOGGER.error('Unable to parse rate limit headers. {0}'.format(e))
     
-    def expirations(self, symbol: str) -> list:
+    def penalize(self, retry_after: float = None) -> None:
         """
-        Need to gather available options expirations before querying the chains.
+        Got a 429, drain the bucket and hold until the window resets.
+        """
+        self.tokens = 0
+        if retry_after:
+            self.hold_until = max(self.hold_until, time() + retry_after)
+        elif self.hold_until < time():
+            self.hold_until = time() + self.window / self.allowed
+    
+    def acquire(self, priority: int = PRIORITY_CHAIN) -> None:
         """
-        url = self.api.format('/v1/markets/options/expirations')
-        params = {'symbol': symbol, 'includeAllRoots': 'true', 'strikes': 'false'}
+        Block until a token is available. Priority doesn't matter when blocking, there is only one caller.
+        """
+        throttled = False
         try:
-            r = requests.get(url, headers=self.headers, params=params)
-            self.ratelimit_available = int(r.headers['X-Ratelimit-Available'])
-            
-            response = r.json()['expirations']
-            
-            if response:
-                return response['date']
-            else:
-                return []
-        except Exception as e:
-            raise Exception('Problem querying expirations for {0}. Status code: {1} Error: {2}'.format(symbol , r.status_code, e))
+            while True:
+                wait = self.delay()
+                if wait <= 0:
+                    self.tokens -= 1
+                    return
+                if not throttled:
+                    _METRICS.throttle_started()
+                    throttled = True
+                sleep(wait)
+        finally:
+            if throttled:
+                _METRICS.throttle_ended()
+    
+    async def acquire_async(self, priority: int = PRIORITY_CHAIN) -> None:
+        """
+        Wait for a token without blocking the event loop. Waiters are served lowest priority first,
+        then first come first served.
+        """
+        #Each asyncio.run gets a new event loop, events can't be carried over.
+        loop = asyncio.get_running_loop()
+        if self._wakeup is None or self._loop is not loop:
+            self._wakeup = asyncio.Event()
+            self._waiters = []
+            self._loop = loop
+        
+        entry = (priority, next(self._seq))
+        heapq.heappush(self._waiters, entry)
+        #Only the waiter at the front counts as throttled, the rest are queued behind it anyway.
+        throttled = False
+        try:
+            while True:
+                if self._waiters[0] == entry:
+                    wait = self.delay()
+                    if wait <= 0:
+                        heapq.heappop(self._waiters)
+                        self.tokens -= 1
+                        return
+                    if not throttled:
+                        _METRICS.throttle_started()
+                        throttled = True
+                    #A higher priority request may show up while sleeping, so don't sleep too long.
+                    await asyncio.sleep(min(wait, 0.25))
+                else:
+                    wakeup = self._wakeup
+                    await wakeup.wait()
+        finally:
+            if throttled:
+                _METRICS.throttle_ended()
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            #Let the next waiter check if it's at the front.
+            self._wakeup.set()
+            self._wakeup = asyncio.Event()
+
+
+class OptionChain(object):
+    __slots__ = ('expiration', 'symbols', 'is_put', 'strike', 'bid', 'ask', 'volume')
+    
+    def __init__(self, expiration: str = None):
+        """
+        One expiration of an options chain stored as parallel typed arrays, keeping only the fields
+        the calculations use instead of every raw Tradier option dict. Missing bids and asks are NaN.
+        """
+        self.expiration = expiration
+        self.symbols = []
+        self.is_put = array('b')
+        self.strike = array('d')
+        self.bid = array('d')
+        self.ask = array('d')
+        self.volume = array('q')
+    
+    def append(self, option: dict) -> None:
+        self.symbols.append(option['symbol'])
+        self.is_put.append(option['option_type'] == 'put')
+        self.strike.append(option['strike'])
+        self.bid.append(nan if option['bid'] is None else option['bid'])
+        self.ask.append(nan if option['ask'] is None else option['ask'])
+        self.volume.append(option.get('volume') or 0)
+    
+    def __len__(self) -> int:
+        return len(self.symbols)
+    
+    def __getstate__(self) -> tuple:
+        return (self.expiration, self.symbols, self.is_put, self.strike, self.bid, self.ask, self.volume)
+    
+    def __setstate__(self, state: tuple) -> None:
+        self.expiration, self.symbols, self.is_put, self.strike, self.bid, self.ask, self.volume = state
+    
+    def update_quote(self, i: int, quote: dict) -> None:
+        """
+        Update bid, ask and volume of an option from a realtime quote, skipping fields it doesn't have.
+        """
+        if 'bid' in quote:
+            self.bid[i] = nan if quote['bid'] is None else quote['bid']
+        if 'ask' in quote:
+            self.ask[i] = nan if quote['ask'] is None else quote['ask']
+        if 'volume' in quote:
+            self.volume[i] = quote['volume'] or 0
+    
+    def option(self, i: int) -> dict:
+        """
+        A single option as a dict, in the same shape as the Tradier fields kept.
+        """
+        return {
+            'symbol': self.symbols[i],
+            'option_type': 'put' if self.is_put[i] else 'call',
+            'strike': self.strike[i],
+            'bid': None if isnan(self.bid[i]) else self.bid[i],
+            'ask': None if isnan(self.ask[i]) else self.ask[i],
+            'volume': self.volume[i],
+            'expiration_date': self.expiration
+        }
+
+
+OCCSymbol = namedtuple('OCCSymbol', ['root', 'expiration', 'option_type', 'strike'])
+
+
+class OCCSymbolIndex(object):
+    def __init__(self):
+        """
+        Parses OSI option symbols like BRKB261120C00450000, root then YYMMDD, C or P and the strike
+        times 1000 padded to 8 digits, and keeps track of every root seen per underlying.
+        
+        OCC gives adjusted contracts a new root, usually the old one with a digit on the end, so
+        anything but the standard root of an underlying is nonstandard.
+        """
+        self.roots = defaultdict(set)
+    
+    @staticmethod
+    @lru_cache(maxsize=OCC_SYMBOL_CACHE_SIZE)
+    def parse(symbol: str) -> OCCSymbol:
+        """
+        Split an option symbol in one pass, the tail is fixed width. Returns None if it isn't one.
+        """
+        if len(symbol) < 16 or not OCC_SYMBOL_TAIL.fullmatch(symbol, len(symbol) - 15):
+            return None
+        
+        return OCCSymbol(
+            root=symbol[:-15].rstrip(),
+            expiration='20{0}-{1}-{2}'.format(symbol[-15:-13], symbol[-13:-11], symbol[-11:-9]),
+            option_type='call' if symbol[-9] == 'C' else 'put',
+            strike=int(symbol[-8:]) / 1000
+        )
+    
+    @staticmethod
+    def standard_root(underlying: str) -> str:
+        return NON_ROOT_CHARACTERS.sub('', underlying.upper())
+    
+    def is_standard(self, underlying: str, symbol: str) -> bool:
+        """
+        True if the option is on the standard root of the underlying. Also records the root.
+        """
+        parsed = self.parse(symbol)
+        if parsed is None:
+            return False
+        self.roots[underlying].add(parsed.root)
+        
+        return parsed.root == self.standard_root(underlying)
+    
+    def adjusted_roots(self, underlying: str) -> set:
+        return self.roots[underlying] - {self.standard_root(underlying)}
+    
+    def adjusted_only(self, underlying: str) -> bool:
+        """
+        True once contracts have been seen for the underlying and none were on its standard root,
+        say after a merger or a share class ticker Tradier lists under another root. The rest
+        of its chains would be filtered out anyway, so there's no point fetching them.
+        """
+        return bool(self.roots[underlying]) and self.adjusted_roots(underlying) == self.roots[underlying]
+
+
+#first_seen defaults to None for history saved before it was tracked, add fills it in.
+OCCMemo = namedtuple('OCCMemo', ['guid', 'title', 'published', 'effective', 'adjustment', 'symbols', 'first_seen'], defaults=(None,))
+
+
+class OCCMemos(object):
+    def __init__(self, memos: list = ()):
+        """
+        OCC info memos parsed into structured records, indexed by the symbols they affect.
+        Dates are '%Y-%m-%d' strings, effective is the latest date mentioned in the memo.
+        """
+        self.memos = {}
+        self.by_symbol = defaultdict(list)
+        for memo in memos:
+            self.add(memo)
+    
+    def __len__(self) -> int:
+        return len(self.memos)
+    
+    @staticmethod
+    def normalize(symbol: str) -> str:
+        #BRK.B, BRK/B and BRKB all mean the same thing.
+        return NON_ROOT_CHARACTERS.sub('', symbol.upper())
+    
+    @staticmethod
+    def _parse_date(text: str) -> str:
+        for date_format in OCC_MEMO_DATE_FORMATS:
+            try:
+                return datetime.strptime(text, date_format).date().isoformat()
+            except ValueError:
+                continue
+        
+        return None
+    
+    @classmethod
+    def parse(cls, title: str, description: str, published: str = None, guid: str = None) -> OCCMemo:
+        """
+        Pull the symbols, dates and adjustment type out of a memo once, instead of searching its text per symbol.
+        """
+        symbols = set()
+        for match in OCC_MEMO_SYMBOLS.finditer(description):
+            symbols.update(symbol.strip() for symbol in match.group(1).split(','))
+        
+        dates = [d for d in (cls._parse_date(text) for text in OCC_MEMO_DATES.findall(description)) if d]
+        
+        try:
+            published = parsedate_to_datetime(published).date().isoformat() if published else None
+        except (TypeError, ValueError):
+            published = None
+        
+        text = '{0} {1}'.format(title, description).lower()
+        adjustment = next((adjustment for keyword, adjustment in OCC_MEMO_ADJUSTMENTS if keyword in text), 'other')
+        
+        return OCCMemo(
+            guid=guid or '{0}|{1}'.format(title, description),
+            title=title,
+            published=published,
+            effective=max(dates) if dates else None,
+            adjustment=adjustment,
+            symbols=tuple(sorted(symbols)),
+            first_seen=date.today().isoformat()
+        )
+    
+    def add(self, memo: OCCMemo) -> None:
+        if memo.guid in self.memos:
+            return
+        if memo.first_seen is None:
+            memo = memo._replace(first_seen=date.today().isoformat())
+        self.memos[memo.guid] = memo
+        for symbol in memo.symbols:
+            self.by_symbol[self.normalize(symbol)].append(memo)
+    
+    def relevant(self, memo: OCCMemo, today: str = None) -> bool:
+        """
+        Memos count from the moment they're seen until OCC_MEMO_LOOKBACK_DAYS after their effective
+        date, or their publication date when they have none. Memos with neither count until
+        OCC_MEMO_UNDATED_DAYS after they were first seen.
+        """
+        today = date.fromisoformat(today or date.today().isoformat())
+        memo_date = memo.effective or memo.published
+        if memo_date is None:
+            return memo.first_seen is None or today - timedelta(days=OCC_MEMO_UNDATED_DAYS) <= date.fromisoformat(memo.first_seen)
+        
+        return memo_date >= (today - timedelta(days=OCC_MEMO_LOOKBACK_DAYS)).isoformat()
+    
+    def affects(self, symbol: str, today: str = None) -> list:
+        """
+        Relevant memos naming this symbol, empty if there aren't any.
+        """
+        return [memo for memo in self.by_symbol.get(self.normalize(symbol), []) if self.relevant(memo, today)]
+    
+    def prune(self, days: int = OCC_MEMO_HISTORY_DAYS) -> None:
+        cutoff = (date.today() - timedelta(days=days)).isoformat()
+        memos = [memo for memo in self.memos.values() if (memo.effective or memo.published or memo.first_seen or cutoff) >= cutoff]
+        self.memos = {}
+        self.by_symbol = defaultdict(list)
+        for memo in memos:
+            self.add(memo)
+        
+        return
+
+
+class OptionsData(APIClient):
+    def __init__(self, api_key: str, cache: CachedData = None):
+        self.headers = {"Accept": "application/json", "Authorization": api_key}
+        self.api = 'https://api.tradier.com{0}'
+        self.occ_url = 'https://infomemo.theocc.com/infomemo-rss'
+        self.ratelimiter = RateLimiter()
+        self.cache = cache
+        self.session = _TRANSPORT
+        self.recorder = None
+        self.occ_index = OCCSymbolIndex()
+        self._semaphore = None
+    
+    def _request(self, endpoint: str, params: dict, priority: int = PRIORITY_CHAIN, method: str = 'GET') -> requests.Response:
+        """
+        Rate limited request against the Tradier API. Retries 429 and 5xx responses with backoff.
+        
+        POST sends the params as a form body, used for long symbol lists.
+        """
+        url = self.api.format(endpoint)
+        for attempt in range(MAX_RETRIES + 1):
+            self.ratelimiter.acquire(priority)
+            started = monotonic()
+            try:
+                #Every attempt goes through the rate limiter, so the adapter mustn't retry behind its back.
+                if method == 'POST':
+                    r = self.session.post(url, headers=self.headers, data=params, retry=False)
+                else:
+                    r = self.session.get(url, headers=self.headers, params=params, retry=False)
+            except requests.exceptions.ConnectionError:
+                if attempt == MAX_RETRIES:
+                    raise
+                _METRICS.observe_retry(url)
+                sleep(RETRY_BACKOFF * 2 ** attempt * random.uniform(1, 1.5))
+                continue
+            
+            self.ratelimiter.update(r.headers)
+            self._record(r, params, started)
+            if r.status_code == 429:
+                self.ratelimiter.penalize(self._retry_after(r.headers))
+            elif r.status_code < 500:
+                return r
+            
+            if attempt < MAX_RETRIES:
+                _LOGGER.warning('Retrying {0} {1}. Status code: {2}'.format(endpoint, params, r.status_code))
+                _METRICS.observe_retry(url)
+                sleep(RETRY_BACKOFF * 2 ** attempt * random.uniform(1, 1.5))
+        
+        return r
+    
+    def _retry_after(self, headers: dict) -> float:
+        try:
+            return float(headers.get('Retry-After', 0))
+        except ValueError:
+            return 0
+    
+    def _quotes_by_symbol(self, response: dict) -> dict:
+        """
+        Tradier returns a single quote as a dict and multiple quotes as a list. Key them by symbol.
+        """
+        quotes = (response.get('quotes') or {}).get('quote') or []
+        if isinstance(quotes, dict):
+            quotes = [quotes]
+        
+        return {quote['symbol']: quote for quote in quotes}
+    
+    def batch_quotes(self, symbols: list, batch_size: int = QUOTE_BATCH_SIZE) -> dict:
+        """
+        Grab realtime quotes for many symbols, underlyings or options, batch_size symbols per call.
+        
+        Returns a dictionary with symbols as keys like {'PSTX': {'data...': 0}}
+        """
+        quotes = {}
+        for i in range(0, len(symbols), batch_size):
+            batch = symbols[i:i + batch_size]
+            r = None
+            try:
+                r = self._request('/v1/markets/quotes', params={'symbols': ','.join(batch)}, priority=PRIORITY_QUOTE, method='POST')
+                quotes.update(self._quotes_by_symbol(r.json()))
+            except Exception as e:
+                raise Exception('Problem querying stock quotes. Status code: {0} Symbols: {1} Error: {2}'.format(
+                    r.status_code if r is not None else None, batch, e
+                ))
+        
+        return quotes
+    
+    def _option_symbols_to_refresh(self, all_data: dict) -> list:
+        """
+        Option symbols the calculations look at, ITM strikes from the fetched chains.
+        """
+        option_symbols = []
+        for v in all_data.values():
+            try:
+                current_underlying_ask = v['realtime_quote']['ask']
+            except (KeyError, TypeError):
+                continue
+            if current_underlying_ask is None:
+                continue
+            for options_chain in v.get('options_data', {}).values():
+                option_symbols.extend([
+                    symbol for symbol, strike in zip(options_chain.symbols, options_chain.strike) if strike >= current_underlying_ask
+                ])
+        
+        return option_symbols
     
-    def options_chain(self, expiration_date: str, symbol: str) -> list:
+    def _join_quotes(self, all_data: dict, quotes: dict) -> None:
         """
-        With the option expiration grab the options chain data.
+        Join batched quotes back into all_data. Underlyings go in realtime_quote, options update
+        their chain entry in place.
         """
-        url = self.api.format('/v1/markets/options/chains')
-        params = {'symbol': symbol, 'expiration': expiration_date, 'greeks': 'true'}
+        for k, v in all_data.items():
+            if k in quotes:
+                v['realtime_quote'] = quotes[k]
+            for options_chain in v.get('options_data', {}).values():
+                for i, symbol in enumerate(options_chain.symbols):
+                    if symbol in quotes:
+                        options_chain.update_quote(i, quotes[symbol])
+        
+        return
+    
+    def refresh_quotes(self, all_data: dict, include_options: bool = False) -> dict:
+        """
+        Batched refresh of the realtime underlying quotes, done right before running calculations so
+        asks are current. Optionally refreshes the ITM options too, which needs the underlying quotes first.
+        """
+        _LOGGER.info('Refreshing realtime quotes for {0} symbols.'.format(len(all_data)))
+        self._join_quotes(all_data, self.batch_quotes(list(all_data.keys())))
+        
+        if include_options:
+            self._join_quotes(all_data, self.batch_quotes(self._option_symbols_to_refresh(all_data)))
+        
+        return all_data
+    
+    def expirations(self, symbol: str) -> list:
+        """
+        Need to gather available options expirations before querying the chains.
+        """
+        return self._cached('expirations', symbol, lambda: self._expirations(symbol))
+    
+    def _expirations(self, symbol: str) -> list:
+        #Only the standard root, expirations that just exist for adjusted contracts aren't worth a chain call.
+        params = {'symbol': symbol, 'includeAllRoots': 'false', 'strikes': 'false'}
+        r = None
         try:
-            r = requests.get(url, headers=self.headers, params=params)
-            self.ratelimit_available = int(r.headers['X-Ratelimit-Available'])
-            options_chain_data = r.json()['options']
+            r = self._request('/v1/markets/options/expirations', params=params, priority=PRIORITY_EXPIRATION)
+            
+            response = r.json()['expirations']
             
-            #Occasionally IEX will report ghost options expirations.
-            if options_chain_data:
-                return options_chain_data['option']
+            if response:
+                return response['date']
             else:
                 return []
         except Exception as e:
-            raise Exception('Problem querying options chain for {0}. Status code: {1} Error: {2}'.format(symbol , r.status_code, e))
+            raise Exception('Problem querying expirations for {0}. Status code: {1} Error: {2}'.format(
+                symbol, r.status_code if r is not None else None, e
+            ))
     
     def grab_options_expirations(self, quotes_dict: dict, raw_divvy_data: dict) -> dict:
         """
@@ -336,103 +1636,392 @@ class OptionsData(object):
         
         return divvies_with_options
     
-    def grab_all_options_data(self, divvies_with_exp: dict) -> dict:
+    def _standard_contract(self, item: dict, underlying: str) -> bool:
         """
-        Grab options data for each symbol to compile a complete picture.
+        Kick out nonstandard sized contracts.
+        """
+        #Throw out nonstandard contract sizes, because these are usually no liquidity.
+        if item['contract_size'] != 100:
+            return False
+        
+        #Haven't seen anything other than standard, but throw it out if it's not standard.
+        if item['expiration_type'] != 'standard':
+            return False
         
-        Options chain and realtime stock quote grabbed at the same time to keep spread data fresh.
+        #Adjusted options and other share classes are on a different root than the underlying's own.
+        if not self.occ_index.is_standard(underlying, item['symbol']):
+            return False
+        
+        return True
+    
+    def _parse_options_chain(self, body: bytes, expiration_date: str, underlying: str) -> OptionChain:
         """
-        _LOGGER.info('Grabbing current stock price and options expirations for {0} symbols.'.format(len(divvies_with_exp)))
+        Decode a chain response straight into an OptionChain, filtering contracts as they're copied
+        so only the fields it keeps of standard contracts outlive the parse.
+        """
+        options_chain = OptionChain(expiration_date)
+        options_chain_data = orjson.loads(body)['options']
+        
+        #Occasionally IEX will report ghost options expirations.
+        if not options_chain_data:
+            return options_chain
+        
+        options = options_chain_data['option']
+        #A chain with a single contract comes back as a dict.
+        if isinstance(options, dict):
+            options = [options]
+        for item in options:
+            if self._standard_contract(item, underlying):
+                options_chain.append(item)
+        
+        return options_chain
+    
+    def refresh_expirations(self, previous_divvies_with_exp: dict, quotes_dict: dict, raw_divvy_data: dict) -> dict:
+        """
+        Incremental version of grab_options_expirations. Diffs the upcoming dividends against the
+        previous snapshot so expirations are only queried for newly added symbols. Symbols whose
+        ex-date has passed are dropped, and known symbols reuse their expirations minus expired ones.
+        
+        Returns a dictionary with tickers as keys like {'PSTX': {'data...': 0}}
+        """
+        today = date.today().isoformat()
+        divvies_with_options = {}
+        new_symbols = {}
+        
+        for k, v in quotes_dict.items():
+            #Too late to own the stock before the ex-date.
+            if raw_divvy_data[k]['exDate'] <= today:
+                continue
+            
+            if k in previous_divvies_with_exp:
+                options_expiration_list = [
+                    expiration for expiration in previous_divvies_with_exp[k]['options_expirations'] if expiration >= today
+                ]
+                if options_expiration_list:
+                    divvies_with_options[k] = {
+                        'quote': v,
+                        'options_expirations': options_expiration_list,
+                        'divvy': raw_divvy_data[k]
+                    }
+            else:
+                new_symbols[k] = v
+        
+        _LOGGER.info('{0} symbols carried over, {1} new, {2} dropped since the last scan.'.format(
+            len(divvies_with_options), len(new_symbols), len(set(previous_divvies_with_exp) - set(divvies_with_options))
+        ))
+        divvies_with_options.update(self.grab_options_expirations(quotes_dict=new_symbols, raw_divvy_data=raw_divvy_data))
+        
+        return divvies_with_options
+    
+    def plan_expirations(self, divvy: dict, expirations: list, window: int = EXPIRATION_WINDOW) -> list:
+        """
+        Work out which expirations the calculations need so the rest of the chains aren't downloaded.
+        
+        That's the first expiration on or after the record date plus the ones after it, up to window
+        expirations in total. A window of None keeps every expiration from the record date onward.
+        """
+        #Dates are '%Y-%m-%d' so they sort and compare as strings, no need to parse them.
+        after_record = [expiration for expiration in sorted(expirations) if expiration >= divvy['recordDate']]
+        if window is None:
+            return after_record
+        
+        return after_record[:window]
+    
+    async def _request_async(self, session: aiohttp.ClientSession, endpoint: str, params: dict, priority: int = PRIORITY_CHAIN, method: str = 'GET', parse: Callable = json.loads):
+        """
+        Async version of _request, returns the body decoded with parse, json by default.
+        """
+        url = self.api.format(endpoint)
+        if method == 'POST':
+            request_kwargs = {'data': params}
+        else:
+            request_kwargs = {'params': params}
         
-        all_data = {}
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
         
-        for k, v in tqdm.tqdm(divvies_with_exp.items()):
-            expirations = v['options_expirations']
+        for attempt in range(MAX_RETRIES + 1):
+            await self.ratelimiter.acquire_async(priority)
+            try:
+                async with self._semaphore:
+                    started = monotonic()
+                    async with session.request(method, url, headers=self.headers, **request_kwargs) as r:
+                        self.ratelimiter.update(r.headers)
+                        status = r.status
+                        body = await r.read()
+                        _METRICS.observe_request(url, status, monotonic() - started, len(body))
+                        if self.recorder is not None:
+                            self.recorder.capture(url, params, status, r.headers, body)
+                        if status == 200:
+                            return parse(body)
+                        elif status == 429:
+                            self.ratelimiter.penalize(self._retry_after(r.headers))
+                        elif status < 500:
+                            raise Exception('Status code: {0}'.format(status))
+            except aiohttp.ClientConnectionError:
+                if attempt == MAX_RETRIES:
+                    raise
+                status = 'connection error'
             
-            all_data[k] = v
+            if attempt < MAX_RETRIES:
+                _LOGGER.warning('Retrying {0} {1}. Status code: {2}'.format(endpoint, params, status))
+                _METRICS.observe_retry(url)
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt * random.uniform(1, 1.5))
+        
+        raise Exception('Status code: {0}'.format(status))
+    
+    async def _options_chain_async(self, session: aiohttp.ClientSession, expiration_date: str, symbol: str, priority: int = PRIORITY_CHAIN) -> OptionChain:
+        """
+        With the option expiration grab the options chain data, standard contracts only.
+        """
+        return await self._cached_async(
+            'chains', '{0}:{1}'.format(symbol, expiration_date),
+            lambda: self._fetch_options_chain_async(session, expiration_date=expiration_date, symbol=symbol, priority=priority)
+        )
+    
+    async def _fetch_options_chain_async(self, session: aiohttp.ClientSession, expiration_date: str, symbol: str, priority: int = PRIORITY_CHAIN) -> OptionChain:
+        params = {'symbol': symbol, 'expiration': expiration_date, 'greeks': 'false'}
+        try:
+            return await self._request_async(
+                session, '/v1/markets/options/chains', params, priority, parse=lambda body: self._parse_options_chain(body, expiration_date, symbol)
+            )
+        except Exception as e:
+            raise Exception('Problem querying options chain for {0}. Error: {1}'.format(symbol, e))
+    
+    async def _expirations_async(self, session: aiohttp.ClientSession, symbol: str) -> list:
+        """
+        Async version of expirations.
+        """
+        return await self._cached_async('expirations', symbol, lambda: self._fetch_expirations_async(session, symbol))
+    
+    async def _fetch_expirations_async(self, session: aiohttp.ClientSession, symbol: str) -> list:
+        params = {'symbol': symbol, 'includeAllRoots': 'false', 'strikes': 'false'}
+        try:
+            response = (await self._request_async(session, '/v1/markets/options/expirations', params, PRIORITY_EXPIRATION))['expirations']
+        except Exception as e:
+            raise Exception('Problem querying expirations for {0}. Error: {1}'.format(symbol, e))
+        
+        return response['date'] if response else []
+    
+    async def grab_options_expirations_async(self, session: aiohttp.ClientSession, quote_batches: asyncio.Queue, raw_divvy_data: dict, progress: bool = True) -> tuple:
+        """
+        Same as grab_options_expirations, but takes batches of quotes off quote_batches as they show
+        up until it gets None, querying expirations for each batch while later ones are still in flight.
+        
+        Returns the quotes and the dictionary grab_options_expirations does, both in raw_divvy_data order.
+        """
+        _LOGGER.info('Querying Tradier for options expirations.')
+        quotes_dict = {}
+        found = {}
+        tasks = []
+        
+        with tqdm.tqdm(total=len(raw_divvy_data), disable=not progress) as pbar:
+            async def _grab(k: str) -> None:
+                options_expiration_list = await self._expirations_async(session, k)
+                if options_expiration_list:
+                    found[k] = options_expiration_list
+                pbar.update(1)
             
-            options_data = {}
-            for expiration in expirations:
-                self.throttle()
-                
-                options_chain = self.options_chain(expiration_date=expiration, symbol=k)
-                
-                #Kick out nonstandard sized contracts.
-                options_chain_standard_contract_size = []
-                for item in options_chain:
-                    #Throw out nonstandard contract sizes, because these are usually no liquidity.
-                    if item['contract_size'] != 100:
-                        continue
-                    
-                    #Haven't seen anything other than standard, but throw it out if it's not standard.
-                    if item['expiration_type'] != 'standard':
-                        continue
-                    
-                    #Ugh, have to regex the symbol! Nonstandard or adjusted options tend to have numbers
-                    #after the ticker, but before the date. Dates follow the C standard '%Y%m%d' so throw
-                    #out any numbers that aren't.
-                    if len(list(filter(None, re.split('[A-Z]', item['symbol'])))[0]) != 6:
-                        continue
-                    
-                    options_chain_standard_contract_size.append(item)
-                    
-                options_data[expiration] = options_chain_standard_contract_size
+            while True:
+                batch = await quote_batches.get()
+                if batch is None:
+                    break
+                quotes_dict.update(batch)
+                tasks.extend([asyncio.ensure_future(_grab(k)) for k in batch.keys()])
             
-            all_data[k]['options_data'] = options_data
-            self.throttle()
+            await asyncio.gather(*tasks)
+        
+        quotes_dict = {k: quotes_dict[k] for k in raw_divvy_data.keys() if k in quotes_dict}
+        divvies_with_options = {
+            k: {'quote': quotes_dict[k], 'options_expirations': found[k], 'divvy': raw_divvy_data[k]} for k in quotes_dict.keys() if k in found
+        }
+        
+        return quotes_dict, divvies_with_options
+    
+    async def _batch_quotes_async(self, session: aiohttp.ClientSession, symbols: list, batch_size: int = QUOTE_BATCH_SIZE) -> dict:
+        """
+        Async version of batch_quotes, batches are fetched concurrently.
+        """
+        batches = [symbols[i:i + batch_size] for i in range(0, len(symbols), batch_size)]
+        try:
+            responses = await asyncio.gather(
+                *[self._request_async(session, '/v1/markets/quotes', {'symbols': ','.join(batch)}, PRIORITY_QUOTE, method='POST') for batch in batches]
+            )
+        except Exception as e:
+            raise Exception('Problem querying stock quotes. Error: {0}'.format(e))
+        
+        quotes = {}
+        for response in responses:
+            quotes.update(self._quotes_by_symbol(response))
+        
+        return quotes
+    
+    async def _grab_symbol_options_data_async(self, session: aiohttp.ClientSession, symbol: str, expirations: list) -> dict:
+        """
+        Fetch every chain for a symbol concurrently. The first one goes out alone when nothing is known
+        about the symbol's roots yet, so the rest aren't fetched if it's only listed on adjusted roots.
+        """
+        if self.occ_index.adjusted_only(symbol) or not expirations:
+            return {}
+        
+        options_chains = []
+        if not self.occ_index.roots[symbol]:
+            options_chains.append(await self._options_chain_async(session, expiration_date=expirations[0], symbol=symbol, priority=PRIORITY_CHAIN))
+            if self.occ_index.adjusted_only(symbol):
+                return dict(zip(expirations, options_chains))
+        
+        options_chains.extend(await asyncio.gather(
+            *[self._options_chain_async(session, expiration_date=expiration, symbol=symbol, priority=PRIORITY_CHAIN + i) for i, expiration in enumerate(expirations) if i >= len(options_chains)]
+        ))
+        
+        return dict(zip(expirations, options_chains))
+    
+    async def grab_all_options_data_async(self, divvies_with_exp: dict, concurrency: int = MAX_CONCURRENT_REQUESTS, expiration_window: int = EXPIRATION_WINDOW, fetch_quotes: bool = True, progress: bool = True) -> dict:
+        """
+        Grab options data for each symbol to compile a complete picture, keeping many chain and quote
+        requests in flight at once so wall time is bound by the Tradier rate limit rather than round
+        trip latency.
+        
+        Only the expirations from plan_expirations are fetched. Realtime stock quotes are grabbed
+        in batches once all chains are in, skip with fetch_quotes if refresh_quotes is run later.
+        """
+        _LOGGER.info('Grabbing current stock price and options expirations for {0} symbols.'.format(len(divvies_with_exp)))
+        
+        self._semaphore = asyncio.Semaphore(concurrency)
+        
+        #Keep the same symbol ordering as the input.
+        all_data = {k: v for k, v in divvies_with_exp.items()}
+        
+        with tqdm.tqdm(total=len(all_data), disable=not progress) as pbar:
+            async def _grab(symbol: str) -> None:
+                expirations = self.plan_expirations(
+                    all_data[symbol]['divvy'], all_data[symbol]['options_expirations'], window=expiration_window
+                )
+                all_data[symbol]['options_data'] = await self._grab_symbol_options_data_async(
+                    session, symbol=symbol, expirations=expirations
+                )
+                pbar.update(1)
             
-            all_data[k]['realtime_quote'] = self.quotes(k)
+            async with _TRANSPORT.client_session() as session:
+                await asyncio.gather(*[_grab(k) for k in all_data.keys()])
+                
+                if fetch_quotes:
+                    self._join_quotes(all_data, await self._batch_quotes_async(session, list(all_data.keys())))
         
         return all_data
     
-    def get_occ_memos(self) -> list:
+    def get_occ_memos(self) -> OCCMemos:
         """
         Looks at the OCC memo rss feed to see if there are any recent memos.
         This prevents putting on an arb with adjusted contract terms.
+        
+        The feed only goes back about a week, so memos are added to a history kept in the cache.
         """
         _LOGGER.info('Grabbing OCC memos rss feed.')
-        memo_titles = []
+        history = self.cache.get('occ_memos', 'history', default=[]) if self.cache is not None else []
+        occmemos = OCCMemos([OCCMemo(**memo) for memo in history])
         try:
-            r = requests.get('https://infomemo.theocc.com/infomemo-rss')
+            started = monotonic()
+            r = self.session.get(self.occ_url)
+            self._record(r, {}, started)
+            #Parsing rss xml feed. pip install lxml, pip install bs4
+            from bs4 import BeautifulSoup as bbb
             soup = bbb(r.content, features='xml')
-            memo_titles = []
             for rssitem in soup.findAll('item'):
-                memo_titles.append(rssitem.find('description').text)
+                fields = {field: rssitem.find(field) for field in ('title', 'description', 'pubDate', 'guid')}
+                fields = {k: v.text if v is not None else None for k, v in fields.items()}
+                occmemos.add(OCCMemos.parse(
+                    title=fields['title'] or '', description=fields['description'] or '', published=fields['pubDate'], guid=fields['guid']
+                ))
         except Exception as e:
             raise Exception('Unable to get OCC memos, {0}'.format(e))
         
-        return memo_titles
+        if self.cache is not None:
+            occmemos.prune()
+            self.cache.set('occ_memos', 'history', [memo._asdict() for memo in occmemos.memos.values()])
+        
+        return occmemos
+
+
+class TopK(object):
+    def __init__(self, k: int):
+        """
+        Bounded min heap keeping the k highest scored items pushed. Ties go to whichever came first.
+        """
+        self.k = k
+        self._heap = []
+        self._seq = itertools.count()
+    
+    def __len__(self) -> int:
+        return len(self._heap)
+    
+    def push(self, score, item) -> None:
+        #Later pushes sort lower on ties, so they're the first to go.
+        entry = (score, -next(self._seq), item)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+    
+    def items(self) -> list:
+        """
+        Highest score first, as (score, item) tuples.
+        """
+        return [(score, item) for score, _, item in sorted(self._heap, key=lambda entry: entry[:2], reverse=True)]
 
 
 class Calculations(object):
     def __init__(self):
         pass
     
-    def find_arbs(self, data: dict, occmemos: list) -> dict:
+    @staticmethod
+    def _days_to_expiration(expiration: str, now: datetime = None) -> int:
+        """
+        Whole days from now until the expiration date's midnight, as shown next to the expiration.
+        """
+        return (datetime.strptime(expiration, "%Y-%m-%d") - (now or datetime.now())).days
+    
+    @staticmethod
+    def _underlying_ask(v: dict):
+        """
+        The realtime ask of the underlying, or None without a usable one. Tradier sends a null ask
+        for halted and illiquid names, and snapshots read back from Parquet have NaN.
+        """
+        ask = v.get('realtime_quote', {}).get('ask')
+        if ask is None or isnan(ask) or ask <= 0:
+            return None
+        
+        return ask
+    
+    def find_arbs(self, data: dict, occmemos: OCCMemos, as_of: datetime = None, contract_cost: Decimal = OPTION_CONTRACT_COST, min_profit: Decimal = 0) -> dict:
         """
         Filter through the data to find underpriced puts.
+        
+        as_of is when the data was scanned, for rerunning old snapshots. contract_cost and min_profit
+        override the fee per contract action and how much profit a trade needs to show up.
         """
         _LOGGER.info('Filtering through data to find arbs.')
         profitable_trades = defaultdict(dict)
+        now = as_of or datetime.now()
         
-        options_fees_paid = OPTION_CONTRACT_COST * CONTRACT_ACTIONS_PER_COLLAR
+        options_fees_paid = contract_cost * CONTRACT_ACTIONS_PER_COLLAR
         
         
         for k, v in data.items():
+            #Tradier didn't return a quote, or one without an ask. Symbol is probably halted or delisted.
+            if self._underlying_ask(v) is None:
+                continue
+            
             current_underlying_ask = round(Decimal(v['realtime_quote']['ask']), 2)
             ex_dividend_date = datetime.strptime(v['divvy']['exDate'], "%Y-%m-%d")
             record_date = datetime.strptime(v['divvy']['recordDate'], "%Y-%m-%d")
             
             #Verify today isn't already the ex-div.
-            if ex_dividend_date.date() == date.today():
+            if ex_dividend_date.date() == now.date():
                 continue
             
             #Verify ticker isn't in an OCC memo.
-            ticker_in_occ_memo = False
-            for memo in occmemos:
-                if 'Symbol: {0}'.format(k.upper()) in memo:
-                    ticker_in_occ_memo = True
-            if ticker_in_occ_memo:
+            if occmemos.affects(k, now.date().isoformat()):
                 continue
             
             #Figure out the next options expiration date after the ex-div.
@@ -445,19 +2034,24 @@ class Calculations(object):
                     #Ordered by earliest first, break once its found.
                     break
             
+            #No expiration after the record date, so nothing to put on.
+            if expiration_after_record not in v['options_data']:
+                continue
+            
             #Iterate through the chain to collect data. First pass.
             #This is needed to combine put and call data to a single strike for symmetric collars.
+            options_chain = v['options_data'][expiration_after_record]
             options_bid_ask_prices = defaultdict(dict)
-            for option in v['options_data'][expiration_after_record]:
-                strike = round(Decimal(option['strike']), 2)
-                option_type = option['option_type']
-                try:
-                    bid = Decimal(option['bid'])
-                    ask = Decimal(option['ask'])
-                except TypeError:
+            for i in range(len(options_chain)):
+                strike = round(Decimal(options_chain.strike[i]), 2)
+                option_type = 'put' if options_chain.is_put[i] else 'call'
+                if isnan(options_chain.bid[i]) or isnan(options_chain.ask[i]):
                     #No bids shows as a nonetype, return zero.
                     bid = Decimal(0)
                     ask = Decimal(0)
+                else:
+                    bid = Decimal(options_chain.bid[i])
+                    ask = Decimal(options_chain.ask[i])
                 
                 #Throw out strikes below the underlying. We only want ITM puts.
                 if strike < current_underlying_ask:
@@ -470,9 +2064,9 @@ class Calculations(object):
                     options_bid_ask_prices[strike]['call_bid'] = round(bid, 2)
             
             #Second (third?) pass, perform calculations.
-            for option in v['options_data'][expiration_after_record]:
-                strike = round(Decimal(option['strike']), 2)
-                option_type = option['option_type']
+            for i in range(len(options_chain)):
+                strike = round(Decimal(options_chain.strike[i]), 2)
+                option_type = 'put' if options_chain.is_put[i] else 'call'
                 
                 #Skip calls, just focus on puts so this is only done once per strike.
                 #And skip strikes that aren't in options_bid_ask_prices meaning they're not ITM puts.
@@ -487,14 +2081,14 @@ class Calculations(object):
                 put_intrinsic_value = ( strike - current_underlying_ask )
                 dividend_amount_usd = v['div_yield']['$']
                 dividend_yield_pcnt =  v['div_yield']['%']
-                put_volume = option['volume']
+                put_volume = options_chain.volume[i]
                 ex_date = v['divvy']['exDate']
-                expiration = option['expiration_date'] + ' ({0})'.format(( datetime.strptime( expiration_after_record, "%Y-%m-%d" )-datetime.now() ).days )
+                expiration = expiration_after_record + ' ({0})'.format(self._days_to_expiration(expiration_after_record, now))
                 
                 profit_per_longconv = round(((( dividend_amount_usd - ( synthetic_short_debit_price - put_intrinsic_value )) * OPTION_CONTRACT_SIZE) - options_fees_paid), 2)
                 
                 #Fill in data for profitable trades to display.
-                if profit_per_longconv > 0:
+                if profit_per_longconv > min_profit:
                     #Only overwrite if yield is higher. This way the optimal strike is chosen.
                     try:
                         yield_for_previous_strike = profitable_trades[k]['div_yield']
@@ -512,71 +2106,1248 @@ class Calculations(object):
                         profitable_trades[k]['expiration'] = expiration
         
         return profitable_trades
-
-
-if __name__ == '__main__':
-    #Grab api keys.
-    key_obj = APIKeys()
-    tradier_api_key = key_obj.tradier_key()
-    iex_key = key_obj.iexcloud_key()
     
-    #Initialize objects.
-    dd_obj = DivvyData(iex_key)
-    opts_obj = OptionsData(tradier_api_key)
-    calcs_obj = Calculations()
-    cache_obj = CachedData()
+    def _to_cents(self, values: np.ndarray) -> np.ndarray:
+        """
+        Round to integer cents the same way round(Decimal(x), 2) does, half to even on the exact binary value.
+        """
+        scaled = values * 100
+        cents = np.rint(scaled)
+        #Multiplying by 100 can land a value on or off a half cent that the exact value isn't on.
+        #There are only a handful of these, so redo them with Decimal.
+        for i in np.flatnonzero(np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-6):
+            cents[i] = int(round(Decimal(float(values[i])), 2) * 100)
+        
+        return cents.astype(np.int64)
     
-    #Check for cache first
-    divvies_with_exp = cache_obj.load()
-    if not divvies_with_exp:
-        #Grab dividend and quotes. This gets the initial list of future dividends
-        #and filters by lit exchanges.
-        raw_divvy_data = dd_obj.initial_divvy_query()
-        quotes_dict = dd_obj.grab_quotes(raw_divvy_data)
+    def _cents_to_str(self, cents: int) -> str:
+        return '{0}{1}.{2:02d}'.format('-' if cents < 0 else '', abs(cents) // 100, abs(cents) % 100)
+    
+    def _last_by_key(self, keys: np.ndarray) -> tuple:
+        """
+        Unique keys and the position of the last occurrence of each, like overwriting a dict in order.
+        """
+        unique_keys, reversed_index = np.unique(keys[::-1], return_index=True)
         
-        #Grab options expirations. This further filters by removing stocks with
-        #no options.
-        divvies_with_exp = opts_obj.grab_options_expirations(quotes_dict=quotes_dict, raw_divvy_data=raw_divvy_data)
+        return unique_keys, len(keys) - 1 - reversed_index
+    
+    def _longconv_candidates(self, data: dict, occmemos: OCCMemos, window: int = 1) -> dict:
+        """
+        Flatten every chain into columnar arrays and calculate the synthetic debit, intrinsic value
+        and long conversion profit for all ITM put strikes and symbols at once with numpy. Prices are
+        kept as integer cents so results match the Decimal math in find_arbs to the cent.
         
-        #Cache.
-        cache_obj.save(divvies_with_exp)
+        window is how many expirations on or after the record date to look at, like plan_expirations.
+        find_arbs only looks at the first one, None takes every fetched chain.
+        
+        Returns a dictionary of arrays with one entry per put strike that has a matching call. Segments
+        are one symbol and expiration each, in symbols and expirations_after_record.
+        """
+        options_fees_paid = OPTION_CONTRACT_COST * CONTRACT_ACTIONS_PER_COLLAR
+        today = date.today().isoformat()
+        
+        #Per segment values, one row per symbol and expiration that makes it through the filters.
+        symbols = []
+        underlying_asks = []
+        profit_bases = []
+        expirations_after_record = []
+        
+        #Per option columns, one array per chain joined at the end.
+        segment = []
+        strike = []
+        bid = []
+        ask = []
+        is_put = []
+        volume = []
+        
+        for k, v in data.items():
+            #Same as find_arbs. A missing ask would be NaN here and wrap around once cast to cents.
+            if self._underlying_ask(v) is None:
+                continue
+            
+            #Verify today isn't already the ex-div. Dates are '%Y-%m-%d', compare them as strings.
+            if v['divvy']['exDate'] == today:
+                continue
+            
+            #Verify ticker isn't in an OCC memo.
+            if occmemos.affects(k):
+                continue
+            
+            #Only the first strike is ever kept and only when the yield beats zero, see find_arbs.
+            if not v['div_yield']['%'] > 0:
+                continue
+            
+            after_record = [expiration_date for expiration_date in sorted(v['options_expirations']) if expiration_date >= v['divvy']['recordDate']]
+            if window is not None:
+                after_record = after_record[:window]
+            
+            for expiration_after_record in after_record:
+                if expiration_after_record not in v['options_data']:
+                    continue
+                
+                options_chain = v['options_data'][expiration_after_record]
+                if not len(options_chain):
+                    continue
+                segment.append(np.full(len(options_chain), len(symbols), dtype=np.int64))
+                strike.append(np.frombuffer(options_chain.strike, dtype=np.float64))
+                bid.append(np.frombuffer(options_chain.bid, dtype=np.float64))
+                ask.append(np.frombuffer(options_chain.ask, dtype=np.float64))
+                is_put.append(np.frombuffer(options_chain.is_put, dtype=np.int8))
+                volume.append(np.frombuffer(options_chain.volume, dtype=np.int64))
+                
+                symbols.append(k)
+                underlying_asks.append(v['realtime_quote']['ask'])
+                #Everything in the profit that doesn't depend on the strike, in exact cents.
+                profit_bases.append(((v['div_yield']['$'] * OPTION_CONTRACT_SIZE) - options_fees_paid) * 100)
+                expirations_after_record.append(expiration_after_record)
+        
+        if not segment:
+            return {}
+        
+        segment = np.concatenate(segment)
+        bid = np.concatenate(bid)
+        ask = np.concatenate(ask)
+        #No bids show as NaN, zero both sides like find_arbs does.
+        unquoted = np.isnan(bid) | np.isnan(ask)
+        bid[unquoted] = 0.0
+        ask[unquoted] = 0.0
+        strike_c = self._to_cents(np.concatenate(strike))
+        bid_c = self._to_cents(bid)
+        ask_c = self._to_cents(ask)
+        is_put = np.concatenate(is_put).astype(bool)
+        underlying_c = self._to_cents(np.array(underlying_asks, dtype=np.float64))
+        
+        #Throw out strikes below the underlying. We only want ITM puts.
+        itm = strike_c >= underlying_c[segment]
+        keys = segment * STRIKE_KEY_SPAN + strike_c
+        put_rows = np.flatnonzero(itm & is_put)
+        call_rows = np.flatnonzero(itm & ~is_put)
+        
+        #Pair puts and calls on the same strike, later duplicates win like the dict in find_arbs.
+        put_keys, put_last = self._last_by_key(keys[put_rows])
+        call_keys, call_last = self._last_by_key(keys[call_rows])
+        put_ask_c = ask_c[put_rows][put_last][np.searchsorted(put_keys, keys[put_rows])]
+        call_position = np.minimum(np.searchsorted(call_keys, keys[put_rows]), max(len(call_keys) - 1, 0))
+        if len(call_keys):
+            has_call = call_keys[call_position] == keys[put_rows]
+            call_bid_c = bid_c[call_rows][call_last][call_position]
+        else:
+            has_call = np.zeros(len(put_rows), dtype=bool)
+            call_bid_c = np.zeros(len(put_rows), dtype=np.int64)
+        
+        put_segment = segment[put_rows]
+        synthetic_short_debit_c = put_ask_c - call_bid_c
+        put_intrinsic_value_c = strike_c[put_rows] - underlying_c[put_segment]
+        
+        #profit = round(base - (debit - intrinsic) * size, 2) in cents. Split the base into its integer
+        #cents and remainder so the round half to even is exact.
+        profit_bases = [(int(base.to_integral_value(rounding=ROUND_FLOOR)), base - base.to_integral_value(rounding=ROUND_FLOOR)) for base in profit_bases]
+        base_floor = np.array([base[0] for base in profit_bases], dtype=np.int64)
+        base_remainder = np.array([(base[1] > Decimal('0.5')) * 2 + (base[1] == Decimal('0.5')) for base in profit_bases], dtype=np.int8)
+        whole_cents = base_floor[put_segment] - (synthetic_short_debit_c - put_intrinsic_value_c) * OPTION_CONTRACT_SIZE
+        remainder = base_remainder[put_segment]
+        profit_c = whole_cents + (remainder == 2) + ((remainder == 1) & (whole_cents % 2 == 1))
+        
+        return {
+            'symbols': symbols,
+            'volume': np.concatenate(volume),
+            'expirations_after_record': expirations_after_record,
+            'underlying_c': underlying_c,
+            'segment': put_segment[has_call],
+            'put_ask_c': put_ask_c[has_call],
+            'call_bid_c': call_bid_c[has_call],
+            'option_rows': put_rows[has_call],
+            'strike_c': strike_c[put_rows][has_call],
+            'profit_c': profit_c[has_call],
+        }
+    
+    def find_arbs_vectorized(self, data: dict, occmemos: OCCMemos) -> dict:
+        """
+        Same results as find_arbs, but calculated for every strike and symbol at once, see _longconv_candidates.
+        """
+        _LOGGER.info('Filtering through data to find arbs.')
+        profitable_trades = defaultdict(dict)
+        
+        candidates = self._longconv_candidates(data, occmemos)
+        if not candidates:
+            return profitable_trades
+        
+        #First profitable put per symbol, in chain order.
+        profit_c = candidates['profit_c']
+        profitable = np.flatnonzero(profit_c > 0)
+        winning_segments, first = np.unique(candidates['segment'][profitable], return_index=True)
+        
+        for symbol_index, winner in zip(winning_segments, profitable[first]):
+            k = candidates['symbols'][symbol_index]
+            v = data[k]
+            expiration_after_record = candidates['expirations_after_record'][symbol_index]
+            days_to_expiration = self._days_to_expiration(expiration_after_record)
+            
+            profitable_trades[k]['strike'] = '${0}'.format(self._cents_to_str(int(candidates['strike_c'][winner])))
+            profitable_trades[k]['underlying'] = '${0}'.format(self._cents_to_str(int(candidates['underlying_c'][symbol_index])))
+            profitable_trades[k]['div_amount'] = '${0}'.format(v['div_yield']['$'])
+            profitable_trades[k]['profit_on_longconv'] = '${0}'.format(self._cents_to_str(int(profit_c[winner])))
+            profitable_trades[k]['div_yield'] = v['div_yield']['%']
+            profitable_trades[k]['ex_date'] = v['divvy']['exDate']
+            profitable_trades[k]['put_volume'] = int(candidates['volume'][candidates['option_rows'][winner]])
+            profitable_trades[k]['expiration'] = expiration_after_record + ' ({0})'.format(days_to_expiration)
+        
+        return profitable_trades
     
-    #Filtered down to symbols with options expirations, grab the chain data.
-    divvies_with_options = opts_obj.grab_all_options_data(divvies_with_exp)
+    def rank_opportunities(self, data: dict, occmemos: OCCMemos, top_k: int = RANK_TOP_K, rank_by: str = 'annualized', window: int = None) -> list:
+        """
+        Score every profitable put strike with a matching call on every fetched expiration from the
+        record date on, and keep the best top_k across the whole universe.
+        
+        Capital is the net debit of a long conversion, 100 shares at the ask plus the put less the call,
+        plus fees. return is profit per dollar of capital, annualized scales it by the days until the
+        expiration, when the trade can be closed out. rank_by picks one of profit, return or annualized.
+        
+        Returns a list of dictionaries, best first.
+        """
+        _LOGGER.info('Ranking long conversions across expirations.')
+        candidates = self._longconv_candidates(data, occmemos, window=window)
+        if not candidates:
+            return []
+        
+        options_fees_paid = OPTION_CONTRACT_COST * CONTRACT_ACTIONS_PER_COLLAR
+        now = datetime.now()
+        segment = candidates['segment']
+        profit_c = candidates['profit_c']
+        capital_c = (candidates['underlying_c'][segment] + candidates['put_ask_c'] - candidates['call_bid_c']) * OPTION_CONTRACT_SIZE + options_fees_paid * 100
+        #Same day count as the main table, at least a day when annualizing trades expiring today.
+        days = np.array([
+            self._days_to_expiration(expiration, now) for expiration in candidates['expirations_after_record']
+        ], dtype=np.int64)[segment]
+        profitable = np.flatnonzero((profit_c > 0) & (capital_c > 0))
+        return_on_capital = profit_c[profitable] / capital_c[profitable]
+        annualized = return_on_capital * 365 / np.maximum(days[profitable], 1)
+        scores = {'profit': profit_c[profitable], 'return': return_on_capital, 'annualized': annualized}[rank_by]
+        
+        top = TopK(top_k)
+        for i, score in enumerate(scores.tolist()):
+            top.push(score, i)
+        
+        opportunities = []
+        for _, i in top.items():
+            row = profitable[i]
+            k = candidates['symbols'][segment[row]]
+            v = data[k]
+            expiration = candidates['expirations_after_record'][segment[row]]
+            opportunities.append({
+                'ticker': k,
+                'expiration': '{0} ({1})'.format(expiration, int(days[row])),
+                'strike': '${0}'.format(self._cents_to_str(int(candidates['strike_c'][row]))),
+                'underlying': '${0}'.format(self._cents_to_str(int(candidates['underlying_c'][segment[row]]))),
+                'put_ask': '${0}'.format(self._cents_to_str(int(candidates['put_ask_c'][row]))),
+                'call_bid': '${0}'.format(self._cents_to_str(int(candidates['call_bid_c'][row]))),
+                'div_amount': '${0}'.format(v['div_yield']['$']),
+                'profit_on_longconv': '${0}'.format(self._cents_to_str(int(profit_c[row]))),
+                'capital': '${0}'.format(self._cents_to_str(int(capital_c[row]))),
+                'return': '{0:.2f}%'.format(return_on_capital[i] * 100),
+                'annualized': '{0:.1f}%'.format(annualized[i] * 100),
+                'put_volume': int(candidates['volume'][candidates['option_rows'][row]]),
+                'ex_date': v['divvy']['exDate']
+            })
+        
+        return opportunities
     
-    #Convert non USD currency divvies into USD.
-    divvies_with_yield = dd_obj.currency_conversion(divvies_with_options)
+    def longconv_profit(self, dividend_amount_usd: Decimal, put_ask, call_bid, strike, underlying_ask) -> Decimal:
+        """
+        Profit on a single long conversion, same math as find_arbs. Used to reprice tracked trades on every tick.
+        """
+        options_fees_paid = OPTION_CONTRACT_COST * CONTRACT_ACTIONS_PER_COLLAR
+        synthetic_short_debit_price = ( round(Decimal(put_ask), 2) - round(Decimal(call_bid), 2) )
+        put_intrinsic_value = ( round(Decimal(strike), 2) - round(Decimal(underlying_ask), 2) )
+        
+        return round(((( dividend_amount_usd - ( synthetic_short_debit_price - put_intrinsic_value )) * OPTION_CONTRACT_SIZE) - options_fees_paid), 2)
     
-    #Grab the RSS feed for OCC memos to filter out special divvies which end up as adjusted contracts and no arb.
-    occmemos = opts_obj.get_occ_memos()
-    
-    #Run calculations with data collected to find arbs.
-    current_arbs = calcs_obj.find_arbs(data = divvies_with_yield, occmemos = occmemos)
-    
-    headers_sym = ['ticker']
-    free_money = []
-    
-    #Fill in headers.
-    for v in current_arbs.values():
-        for k in v.keys():
-            headers_sym.append(k)
-        break
-    
-    #Fill in a list to display, ordered by highest div_yield.
-    for item in sorted(current_arbs.items(), key=lambda x: x[1]['div_yield'], reverse=True):
-        _temp_list = []
-        _temp_list.append(item[0])
-        for k, v in item[1].items():
-            #Add % after sorting. Have to do after otherwise it messes up sorting.
-            if k == 'div_yield':
-                _temp_list.append('{0}%'.format(v))
-            else:
-                _temp_list.append(v)
-        free_money.append(_temp_list)
+    def headroom(self, data: dict, occmemos: OCCMemos) -> dict:
+        """
+        Best long conversion profit per symbol in dollars, including losing ones. Shows how close
+        a symbol is to having an arb. Symbols with no ITM put and call pair are left out.
+        """
+        candidates = self._longconv_candidates(data, occmemos)
+        if not candidates:
+            return {}
+        
+        best_profit_c = np.full(len(candidates['symbols']), np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(best_profit_c, candidates['segment'], candidates['profit_c'])
+        
+        return {
+            k: Decimal(int(profit_c)) / 100
+            for k, profit_c in zip(candidates['symbols'], best_profit_c) if profit_c != np.iinfo(np.int64).min
+        }
+    
+    def table(self, current_arbs: dict) -> tuple:
+        """
+        Rows and headers to display, ordered by highest div_yield.
+        """
+        headers_sym = ['ticker']
+        free_money = []
+        
+        #Fill in headers.
+        for v in current_arbs.values():
+            for k in v.keys():
+                headers_sym.append(k)
+            break
+        
+        #Fill in a list to display, ordered by highest div_yield.
+        for item in sorted(current_arbs.items(), key=lambda x: x[1]['div_yield'], reverse=True):
+            _temp_list = []
+            _temp_list.append(item[0])
+            for k, v in item[1].items():
+                #Add % after sorting. Have to do after otherwise it messes up sorting.
+                if k == 'div_yield':
+                    _temp_list.append('{0}%'.format(v))
+                else:
+                    _temp_list.append(v)
+            free_money.append(_temp_list)
+        
+        return free_money, headers_sym
+    
+    @staticmethod
+    def last_prices(quotes: dict) -> dict:
+        """
+        Last trade per symbol out of Tradier quotes keyed by symbol, symbols without one are left out.
+        """
+        return {k: quote['last'] for k, quote in quotes.items() if quote and quote.get('last')}
+    
+    def headroom_entries(self, headroom: dict, divvies_with_exp: dict, prices: dict, checked: float = None) -> dict:
+        """
+        Headroom of scanned symbols as kept in the snapshot, along with when they were checked and
+        the realtime underlying price from prices at the time. Symbols headroom left out, with no ITM
+        put and call pair, get a profit of None.
+        """
+        checked = checked or time()
+        return {
+            k: {'profit': headroom.get(k), 'checked': checked, 'underlying': prices.get(k)}
+            for k in divvies_with_exp.keys()
+        }
+    
+    def arb_still_possible(self, divvies_with_exp: dict, previous_headroom: dict, prices: dict, threshold: Decimal = INCREMENTAL_HEADROOM,
+                           max_age: float = INCREMENTAL_RECHECK_AGE, move: Decimal = INCREMENTAL_RECHECK_MOVE) -> dict:
+        """
+        Symbols worth refetching chains for. Previously scanned ones are only skipped if the last scan
+        had them more than threshold dollars from a profitable trade, that was less than max_age
+        seconds ago and the underlying hasn't moved more than move since. Everything else is in:
+        new symbols, ones the last scan couldn't price and entries from older snapshots.
+        
+        prices are realtime underlying prices, see last_prices. The IEX quotes in divvies_with_exp are
+        cached for an hour, too long to tell whether anything moved.
+        """
+        now = time()
+        still_possible = {}
+        for k, v in divvies_with_exp.items():
+            entry = previous_headroom.get(k)
+            if isinstance(entry, dict) and entry['profit'] is not None and entry['profit'] < -threshold and now - entry['checked'] < max_age:
+                underlying = prices.get(k)
+                if underlying and entry['underlying'] and abs(Decimal(str(underlying)) / Decimal(str(entry['underlying'])) - 1) <= move:
+                    continue
+            still_possible[k] = v
+        
+        return still_possible
+
+
+class ColdStart(object):
+    def __init__(self, dd_obj: DivvyData, opts_obj: OptionsData):
+        """
+        The first scan of the day as overlapping stages. IEX quote batches are fetched concurrently
+        and each flows straight into Tradier expiration discovery, so the run is bound by the rate
+        limits instead of waiting on every quote first.
+        """
+        self.dd_obj = dd_obj
+        self.opts_obj = opts_obj
+    
+    async def run(self, raw_divvy_data: dict, progress: bool = True) -> tuple:
+        """
+        Returns the same quotes_dict and divvies_with_exp as grab_quotes and grab_options_expirations.
+        """
+        quote_batches = asyncio.Queue()
+        async with _TRANSPORT.client_session() as session:
+            async def _quotes() -> None:
+                try:
+                    await self.dd_obj.grab_quotes_async(session, raw_divvy_data, quote_batches)
+                finally:
+                    #Let expiration discovery know there's nothing else coming.
+                    await quote_batches.put(None)
+            
+            _, (quotes_dict, divvies_with_exp) = await asyncio.gather(
+                _quotes(), self.opts_obj.grab_options_expirations_async(session, quote_batches, raw_divvy_data, progress=progress)
+            )
+        
+        return quotes_dict, divvies_with_exp
+
+
+class ShardedScan(object):
+    def __init__(self, shards: int, tradier_api_key: str, iex_key: str, base_url: str = None, budget_share: float = None, expiration_window: int = EXPIRATION_WINDOW):
+        """
+        Splits the chain sweep and calculations across a pool of worker processes. Every worker
+        gets its own clients and 1/shards of the Tradier rate budget unless told otherwise.
+        """
+        self.shards = shards
+        self.tradier_api_key = tradier_api_key
+        self.iex_key = iex_key
+        self.base_url = base_url
+        self.budget_share = budget_share if budget_share is not None else 1 / shards
+        self.expiration_window = expiration_window
+    
+    @staticmethod
+    def shard_of(symbol: str, shards: int) -> int:
+        """
+        Stable across processes and hosts, unlike hash() which is salted per interpreter.
+        """
+        return zlib.crc32(symbol.encode('utf-8')) % shards
+    
+    @staticmethod
+    def partition(data: dict, shards: int) -> list:
+        """
+        Split a symbol keyed dict into shards, each in sorted symbol order.
+        """
+        partitions = [{} for _ in range(shards)]
+        for k in sorted(data.keys()):
+            partitions[ShardedScan.shard_of(k, shards)][k] = data[k]
+        
+        return partitions
+    
+    @staticmethod
+    def _init_worker() -> None:
+        """
+        Workers are forked, so they start with the parent's transport and metrics. Pooled keep alive
+        sockets can't be shared between processes without replies getting crossed, so each worker
+        gets its own connections. The parent's sessions are dropped rather than closed, closing them
+        here would tear down connections the parent is still using.
+        """
+        global _TRANSPORT
+        _TRANSPORT = HTTPTransport()
+    
+    @staticmethod
+    def scan_shard(divvies_with_exp: dict, occmemos: OCCMemos, tradier_api_key: str, iex_key: str, base_url: str = None, budget_share: float = 1, expiration_window: int = EXPIRATION_WINDOW, fx_rates: dict = None) -> dict:
+        """
+        Everything after expiration discovery for one shard: chains, yields, realtime quotes and arbs.
+        Runs in a worker process, so no cache and no progress bar.
+        """
+        #Only count this shard's requests. The parent's counts came along with the fork, and a
+        #worker can be handed more than one shard.
+        global _METRICS
+        _METRICS = Metrics()
+        
+        dd_obj = DivvyData(iex_key)
+        opts_obj = OptionsData(tradier_api_key)
+        opts_obj.ratelimiter = RateLimiter(share=budget_share)
+        calcs_obj = Calculations()
+        if base_url:
+            dd_obj.api = base_url + '{0}'
+            opts_obj.api = base_url + '{0}'
+        
+        divvies_with_options = asyncio.run(opts_obj.grab_all_options_data_async(
+            divvies_with_exp, expiration_window=expiration_window, fetch_quotes=False, progress=False
+        ))
+        divvies_with_yield = dd_obj.currency_conversion(divvies_with_options, fx_rates=fx_rates)
+        opts_obj.refresh_quotes(divvies_with_yield)
+        
+        return {
+            'data': dict(divvies_with_yield),
+            'arbs': dict(calcs_obj.find_arbs_vectorized(data=divvies_with_yield, occmemos=occmemos)),
+            'headroom': calcs_obj.headroom(data=divvies_with_yield, occmemos=occmemos),
+            'metrics': _METRICS.report()
+        }
+    
+    @staticmethod
+    def merge(results: list) -> dict:
+        """
+        Combine shard results in sorted symbol order, so the merged output doesn't depend on
+        which shard finished first.
+        """
+        merged = {'data': {}, 'arbs': {}, 'headroom': {}}
+        for field in merged.keys():
+            combined = {}
+            for result in results:
+                combined.update(result.get(field, {}))
+            merged[field] = {k: combined[k] for k in sorted(combined.keys())}
+        
+        return merged
+    
+    def run(self, divvies_with_exp: dict, occmemos: OCCMemos, fx_rates: dict = None) -> dict:
+        """
+        Scan every shard in its own process and merge the results. fx_rates are shared with every
+        shard so each doesn't make its own call.
+        
+        Returns {'data': divvies_with_yield, 'arbs': current_arbs, 'headroom': headroom}
+        """
+        partitions = [p for p in self.partition(divvies_with_exp, self.shards) if p]
+        _LOGGER.info('Scanning {0} symbols in {1} shards.'.format(len(divvies_with_exp), len(partitions)))
+        
+        with ProcessPoolExecutor(max_workers=len(partitions) or 1, initializer=self._init_worker) as pool:
+            futures = [
+                pool.submit(
+                    self.scan_shard, partition, occmemos, self.tradier_api_key, self.iex_key, self.base_url, self.budget_share, self.expiration_window, fx_rates
+                )
+                for partition in partitions
+            ]
+            results = [future.result() for future in futures]
+        
+        for result in results:
+            _METRICS.merge(result['metrics'])
+        
+        return self.merge(results)
+    
+    @staticmethod
+    def save_results(filepath: str, current_arbs: dict, headroom: dict) -> None:
+        """
+        Write the arbs and headroom of a --shard node for merging elsewhere.
+        """
+        with open(filepath, 'w') as f:
+            json.dump({'arbs': current_arbs, 'headroom': headroom}, f, default=str, indent=2)
+        
+        return
+    
+    @staticmethod
+    def load_results(filepath: str) -> dict:
+        with open(filepath, 'r') as f:
+            results = json.load(f)
+        
+        for v in results['arbs'].values():
+            v['div_yield'] = Decimal(v['div_yield'])
+        results['headroom'] = {k: Decimal(v) if v is not None else None for k, v in results['headroom'].items()}
+        
+        return results
+
+
+class Watcher(object):
+    def __init__(self, opts_obj: OptionsData, calcs_obj: Calculations, interval: float = WATCH_INTERVAL, threshold: Decimal = WATCH_HEADROOM):
+        """
+        Keeps re-evaluating the symbols closest to an arb after the full sweep.
+        
+        opts_obj should not have a cache, the chains need to be fresh every poll.
+        """
+        self.opts_obj = opts_obj
+        self.calcs_obj = calcs_obj
+        self.interval = interval
+        self.threshold = threshold
+    
+    def hot_set(self, data: dict, occmemos: OCCMemos) -> dict:
+        """
+        Symbols with a long conversion within threshold dollars of profitable, or already profitable.
+        """
+        headroom = self.calcs_obj.headroom(data=data, occmemos=occmemos)
+        
+        return {k: data[k] for k, profit in headroom.items() if profit >= -self.threshold}
+    
+    def changes(self, previous_arbs: dict, current_arbs: dict) -> list:
+        """
+        Describe what changed between two find_arbs results, one line per symbol.
+        """
+        lines = []
+        for k, v in current_arbs.items():
+            if k not in previous_arbs:
+                lines.append('+ {0} strike {1} profit {2} expiration {3}'.format(k, v['strike'], v['profit_on_longconv'], v['expiration']))
+            elif v['strike'] != previous_arbs[k]['strike'] or v['profit_on_longconv'] != previous_arbs[k]['profit_on_longconv']:
+                lines.append('~ {0} strike {1} profit {2} (was strike {3} profit {4})'.format(
+                    k, v['strike'], v['profit_on_longconv'], previous_arbs[k]['strike'], previous_arbs[k]['profit_on_longconv']
+                ))
+        for k in previous_arbs.keys():
+            if k not in current_arbs:
+                lines.append('- {0} no longer profitable'.format(k))
+        
+        return lines
+    
+    def poll(self, hot: dict, occmemos: OCCMemos) -> dict:
+        """
+        Refetch the chain the calculation needs and the realtime quote for the hot set, then rerun it.
+        """
+        asyncio.run(self.opts_obj.grab_all_options_data_async(hot, progress=False))
+        
+        return self.calcs_obj.find_arbs_vectorized(data=hot, occmemos=occmemos)
+    
+    def run(self, data: dict, occmemos: OCCMemos, current_arbs: dict) -> None:
+        """
+        Poll the hot set forever, printing changes as they happen. Ctrl-C to stop.
+        """
+        hot = self.hot_set(data, occmemos)
+        current_arbs = {k: v for k, v in current_arbs.items() if k in hot}
+        print('Watching {0} symbols within ${1} of an arb every {2} seconds.'.format(len(hot), self.threshold, self.interval))
+        
+        try:
+            while hot:
+                started = monotonic()
+                latest_arbs = self.poll(hot, occmemos)
+                for line in self.changes(current_arbs, latest_arbs):
+                    print('{0} {1}'.format(strftime('%H:%M:%S'), line))
+                current_arbs = latest_arbs
+                
+                #Symbols that drift too far away drop out of the hot set.
+                hot = self.hot_set(hot, occmemos)
+                sleep(max(self.interval - (monotonic() - started), 0))
+        except KeyboardInterrupt:
+            pass
+        
+        return
+
+
+class QuoteStream(object):
+    def __init__(self, opts_obj: OptionsData, calcs_obj: Calculations, stream_url: str = TRADIER_STREAM_URL, record_path: str = None):
+        """
+        Streams Tradier quotes for the underlyings and the put/call pairs find_arbs picked, keeping
+        an in memory snapshot of the latest bid/ask per symbol and repricing the trades on every tick.
+        
+        Point stream_url at a local server to replay recorded messages instead, see divvyreplay.py.
+        record_path appends every raw message received as json lines so it can be replayed later.
+        """
+        self.opts_obj = opts_obj
+        self.calcs_obj = calcs_obj
+        self.stream_url = stream_url
+        self.record_path = record_path
+        #Latest quote per symbol like {'PSTX': {'bid': 1.0, 'ask': 1.05}}
+        self.book = {}
+        #Tracked trades per underlying like {'PSTX': {'put': 'PSTX...P...', 'call': 'PSTX...C...', 'strike': Decimal('12.50')}}
+        self.tracked = {}
+        self.profits = {}
+    
+    def track(self, data: dict, current_arbs: dict) -> list:
+        """
+        Pick out the option symbols for the strikes in current_arbs and seed the book from the chain data.
+        
+        Returns the list of symbols to subscribe to.
+        """
+        for k, v in current_arbs.items():
+            strike = Decimal(v['strike'].lstrip('$'))
+            expiration = v['expiration'].split(' ')[0]
+            pair = {}
+            options_chain = data[k]['options_data'].get(expiration, OptionChain(expiration))
+            for i in range(len(options_chain)):
+                if round(Decimal(options_chain.strike[i]), 2) == strike:
+                    option = options_chain.option(i)
+                    pair[option['option_type']] = option
+            if 'put' not in pair or 'call' not in pair:
+                continue
+            
+            self.tracked[k] = {
+                'put': pair['put']['symbol'],
+                'call': pair['call']['symbol'],
+                'strike': strike,
+                'dividend': data[k]['div_yield']['$']
+            }
+            self.book[k] = {'bid': data[k]['realtime_quote']['bid'], 'ask': data[k]['realtime_quote']['ask']}
+            for option in pair.values():
+                self.book[option['symbol']] = {'bid': option['bid'] or 0, 'ask': option['ask'] or 0}
+        
+        symbols = []
+        for k, v in self.tracked.items():
+            symbols.extend([k, v['put'], v['call']])
+        
+        return symbols
+    
+    def reprice(self, underlying: str) -> Decimal:
+        """
+        Profit on the tracked trade for an underlying using the latest book.
+        """
+        trade = self.tracked[underlying]
+        
+        return self.calcs_obj.longconv_profit(
+            dividend_amount_usd=trade['dividend'],
+            put_ask=self.book[trade['put']]['ask'],
+            call_bid=self.book[trade['call']]['bid'],
+            strike=trade['strike'],
+            underlying_ask=self.book[underlying]['ask']
+        )
+    
+    def on_message(self, message: dict) -> dict:
+        """
+        Apply a streamed quote to the book and reprice affected trades.
+        
+        Returns the trades whose profit changed like {'PSTX': Decimal('12.00')}
+        """
+        if message.get('type') != 'quote' or message.get('symbol') not in self.book:
+            return {}
+        
+        symbol = message['symbol']
+        for field in ('bid', 'ask'):
+            if message.get(field) is not None:
+                self.book[symbol][field] = message[field]
+        
+        changed = {}
+        for k, trade in self.tracked.items():
+            if symbol in (k, trade['put'], trade['call']):
+                profit = self.reprice(k)
+                if profit != self.profits.get(k):
+                    self.profits[k] = profit
+                    changed[k] = profit
+        
+        return changed
+    
+    async def create_session(self, session: aiohttp.ClientSession) -> str:
+        """
+        Streaming needs a short lived session id from the REST api.
+        """
+        response = await self.opts_obj._request_async(session, '/v1/markets/events/session', {}, PRIORITY_QUOTE, method='POST')
+        
+        return response['stream']['sessionid']
+    
+    async def run(self, symbols: list, on_change: Callable, sessionid: str = None, duration: float = None) -> None:
+        """
+        Subscribe to the symbols and call on_change(underlying, profit) whenever a tracked trade reprices.
+        Runs until the stream closes, or for duration seconds.
+        """
+        async with _TRANSPORT.client_session() as session:
+            if sessionid is None:
+                sessionid = await self.create_session(session)
+            
+            async with session.ws_connect(self.stream_url) as ws:
+                await ws.send_json({'symbols': symbols, 'sessionid': sessionid, 'filter': ['quote'], 'linebreak': True})
+                
+                stop_at = monotonic() + duration if duration else None
+                while stop_at is None or monotonic() < stop_at:
+                    try:
+                        msg = await ws.receive(timeout=stop_at - monotonic() if stop_at else None)
+                    except asyncio.TimeoutError:
+                        break
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    
+                    #With linebreak on, one frame can hold several messages.
+                    for line in msg.data.splitlines():
+                        if not line.strip():
+                            continue
+                        if self.record_path:
+                            with open(self.record_path, 'a') as f:
+                                f.write(line + '\n')
+                        for k, profit in self.on_message(json.loads(line)).items():
+                            on_change(k, profit)
+        
+        return
+
+
+class Backtest(object):
+    def __init__(self, store: SnapshotStore, calcs_obj: Calculations):
+        """
+        Reruns find_arbs over every scan in the history, for tuning fee and threshold assumptions
+        against what was actually seen.
+        """
+        self.store = store
+        self.calcs_obj = calcs_obj
+    
+    def run(self, occmemos: OCCMemos, since: str = None, until: str = None, contract_cost: Decimal = OPTION_CONTRACT_COST, min_profit: Decimal = 0) -> list:
+        """
+        Returns every trade found as a dict, the same fields as the scan table plus when it was scanned.
+        """
+        trades = []
+        for scanned_at, data in self.store.scans(since, until):
+            current_arbs = self.calcs_obj.find_arbs(data, occmemos, as_of=scanned_at, contract_cost=contract_cost, min_profit=min_profit)
+            free_money, headers_sym = self.calcs_obj.table(current_arbs)
+            for row in free_money:
+                trades.append(OrderedDict([('scanned', scanned_at.isoformat(sep=' '))] + list(zip(headers_sym, row))))
+        
+        return trades
+
+
+class ScanPipeline(object):
+    def __init__(self, dd_obj: DivvyData, opts_obj: OptionsData, calcs_obj: Calculations, sinks: list = None, store: SnapshotStore = None,
+                 expiration_window: int = EXPIRATION_WINDOW, batch_size: int = PIPELINE_BATCH_SIZE, batch_wait: float = PIPELINE_BATCH_WAIT):
+        """
+        Streaming version of the chain sweep and calculations. Symbols are evaluated in micro batches
+        as soon as their chains are in: realtime quotes, yield and arbs, then the trades found go
+        out to every sink and the chains are dropped. Only the chains in flight or waiting on their
+        batch are ever held in memory.
+        
+        store optionally gets every batch appended to the scan history. The sinks are closed once
+        the run is over, whether or not it finished.
+        """
+        self.dd_obj = dd_obj
+        self.opts_obj = opts_obj
+        self.calcs_obj = calcs_obj
+        self.sinks = sinks or []
+        self.store = store
+        self.expiration_window = expiration_window
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+    
+    async def _next_batch(self, ready: asyncio.Queue, remaining: int) -> list:
+        """
+        Wait for a symbol, then up to batch_wait for more to fill the batch.
+        """
+        batch = [await ready.get()]
+        deadline = monotonic() + self.batch_wait
+        while len(batch) < min(self.batch_size, remaining):
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(ready.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        
+        return batch
+    
+    def _evaluate(self, batch_data: dict, quotes: dict, occmemos: OCCMemos, fx_rates: dict, scanned_at: datetime) -> tuple:
+        self.opts_obj._join_quotes(batch_data, quotes)
+        batch_data = self.dd_obj.currency_conversion(batch_data, fx_rates=fx_rates)
+        current_arbs = self.calcs_obj.find_arbs_vectorized(data=batch_data, occmemos=occmemos)
+        headroom = self.calcs_obj.headroom(data=batch_data, occmemos=occmemos)
+        if self.store is not None:
+            self.store.append(batch_data, scanned_at=scanned_at)
+        
+        return current_arbs, headroom
+    
+    async def run(self, divvies_with_exp: dict, occmemos: OCCMemos, progress: bool = True) -> tuple:
+        """
+        Returns the same current_arbs and headroom as the batch scan, in divvies_with_exp order.
+        """
+        _LOGGER.info('Streaming options data and arbs for {0} symbols.'.format(len(divvies_with_exp)))
+        try:
+            current_arbs, headroom = await self._run(divvies_with_exp, occmemos, progress)
+        finally:
+            for sink in self.sinks:
+                sink.close()
+        
+        #Back in symbol order rather than the order batches finished in.
+        current_arbs = {k: current_arbs[k] for k in divvies_with_exp.keys() if k in current_arbs}
+        headroom = {k: headroom[k] for k in divvies_with_exp.keys() if k in headroom}
+        
+        return current_arbs, headroom
+    
+    async def _run(self, divvies_with_exp: dict, occmemos: OCCMemos, progress: bool) -> tuple:
+        fx_rates = self.dd_obj.fx_rates(self.dd_obj.foreign_currencies(divvies_with_exp))
+        scanned_at = datetime.now()
+        self.opts_obj._semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        ready = asyncio.Queue()
+        current_arbs = {}
+        headroom = {}
+        
+        #A batch worth of symbols in flight, freed up one by one as their chains come in. Any more and
+        #every symbol's chains interleave, so none finish until the end.
+        in_flight = asyncio.Semaphore(self.batch_size)
+        
+        async with _TRANSPORT.client_session() as session:
+            async def _grab(symbol: str) -> None:
+                #A copy, so the chains can be dropped once evaluated without touching divvies_with_exp.
+                item = dict(divvies_with_exp[symbol])
+                try:
+                    expirations = self.opts_obj.plan_expirations(item['divvy'], item['options_expirations'], window=self.expiration_window)
+                    async with in_flight:
+                        item['options_data'] = await self.opts_obj._grab_symbol_options_data_async(session, symbol=symbol, expirations=expirations)
+                except Exception as e:
+                    await ready.put((symbol, e))
+                    return
+                await ready.put((symbol, item))
+            
+            tasks = [asyncio.ensure_future(_grab(k)) for k in divvies_with_exp.keys()]
+            remaining = len(tasks)
+            try:
+                with tqdm.tqdm(total=remaining, disable=not progress) as pbar:
+                    while remaining:
+                        batch = await self._next_batch(ready, remaining)
+                        remaining -= len(batch)
+                        for symbol, item in batch:
+                            if isinstance(item, Exception):
+                                raise item
+                        
+                        batch_data = {symbol: item for symbol, item in batch}
+                        quotes = await self.opts_obj._batch_quotes_async(session, list(batch_data.keys()))
+                        batch_arbs, batch_headroom = self._evaluate(batch_data, quotes, occmemos, fx_rates, scanned_at)
+                        current_arbs.update(batch_arbs)
+                        headroom.update(batch_headroom)
+                        if batch_arbs:
+                            for sink in self.sinks:
+                                sink.write(batch_arbs)
+                        pbar.update(len(batch))
+            finally:
+                for task in tasks:
+                    task.cancel()
+        
+        return current_arbs, headroom
+
+
+class JsonLinesSink(object):
+    def __init__(self, filepath: str):
+        """
+        Appends every trade found to a json lines file as it comes in, one trade per line.
+        """
+        self.filepath = filepath
+        self._file = open(filepath, 'a')
+    
+    def write(self, current_arbs: dict) -> None:
+        found_at = datetime.now().isoformat(timespec='seconds')
+        for k, v in current_arbs.items():
+            self._file.write(json.dumps(dict([('found_at', found_at), ('ticker', k)] + list(v.items())), default=str) + '\n')
+        self._file.flush()
+    
+    def close(self) -> None:
+        self._file.close()
+
+
+class CSVSink(object):
+    def __init__(self, filepath: str):
+        """
+        Appends every trade found to a csv file as it comes in. The header is written with the first trade.
+        """
+        self.filepath = filepath
+        self._file = open(filepath, 'a', newline='')
+        self._writer = None
+    
+    def write(self, current_arbs: dict) -> None:
+        found_at = datetime.now().isoformat(timespec='seconds')
+        for k, v in current_arbs.items():
+            row = OrderedDict([('found_at', found_at), ('ticker', k)] + list(v.items()))
+            if self._writer is None:
+                self._writer = csv.DictWriter(self._file, fieldnames=list(row.keys()))
+                if self._file.tell() == 0:
+                    self._writer.writeheader()
+            self._writer.writerow(row)
+        self._file.flush()
+    
+    def close(self) -> None:
+        self._file.close()
+
+
+class LiveTableSink(object):
+    def __init__(self, width: int = 14):
+        """
+        Prints each trade as a table row the moment it's found, above the progress bar.
+        """
+        self.width = width
+        self._widths = None
+    
+    def _line(self, cells: list) -> str:
+        return ''.join(str(cell).ljust(width) for cell, width in zip(cells, self._widths))
+    
+    def write(self, current_arbs: dict) -> None:
+        for k, v in current_arbs.items():
+            if self._widths is None:
+                headers = ['ticker'] + list(v.keys())
+                self._widths = [max(self.width, len(header) + 2) for header in headers]
+                tqdm.tqdm.write(self._line([header.upper() for header in headers]))
+            tqdm.tqdm.write(self._line([k] + ['{0}%'.format(value) if field == 'div_yield' else value for field, value in v.items()]))
+    
+    def close(self) -> None:
+        return
+
+
+def _print_arbs(calcs_obj: Calculations, current_arbs: dict) -> None:
+    free_money, headers_sym = calcs_obj.table(current_arbs)
     
     if free_money:
         print('Profitable long conversion arbitrage trades using dividends:')
         print(columnar(free_money, headers_sym, no_borders=True, patterns=[]))
     else:
         print('There are no current arbitrage opportunities.')
-    
\ No newline at end of file
+
+
+def _file_sinks(args: argparse.Namespace) -> list:
+    return ([JsonLinesSink(args.jsonl)] if args.jsonl else []) + ([CSVSink(args.csv)] if args.csv else [])
+
+
+def _saved_cache() -> CachedData:
+    #Opening a cache creates the file, which the read only commands shouldn't leave behind.
+    if not path.exists(CACHE_FILENAME):
+        return None
+    
+    return CachedData()
+
+
+def _cached_occ_memos(cache_obj: CachedData) -> OCCMemos:
+    #Offline, so only the memos already in the cache are used.
+    if cache_obj is None:
+        return OCCMemos()
+    
+    return OCCMemos([OCCMemo(**memo) for memo in cache_obj.get('occ_memos', 'history', default=[])])
+
+
+def rescore(args: argparse.Namespace, parser: argparse.ArgumentParser) -> None:
+    """
+    Rerun find_arbs over the chains of the last scan, or every scan in the history, with other fees
+    and thresholds. Nothing is fetched and no api keys are needed.
+    """
+    calcs_obj = Calculations()
+    cache_obj = _saved_cache()
+    occmemos = _cached_occ_memos(cache_obj)
+    
+    if args.history:
+        trades = Backtest(SnapshotStore(args.history_dir), calcs_obj).run(
+            occmemos, since=args.since, until=args.until, contract_cost=args.contract_cost, min_profit=args.min_profit
+        )
+        if trades:
+            print('Long conversion trades found in the history:')
+            print(columnar([list(trade.values()) for trade in trades], list(trades[0].keys()), no_borders=True, patterns=[]))
+        else:
+            print('No trades found in the history.')
+        return
+    
+    last_scan = cache_obj.load_last_scan() if cache_obj is not None else None
+    if last_scan is None or last_scan['data'] is None:
+        parser.error('No chains saved from the last scan. Run a scan without --pipeline or --shard first.')
+    
+    print('Rescoring the scan from {0}.'.format(last_scan['scanned_at'].strftime('%Y-%m-%d %H:%M:%S')))
+    _print_arbs(calcs_obj, calcs_obj.find_arbs(
+        last_scan['data'], occmemos, contract_cost=args.contract_cost, min_profit=args.min_profit
+    ))
+
+
+def show(args: argparse.Namespace, parser: argparse.ArgumentParser) -> None:
+    """
+    Display the trades of the last scan, or merge and display the results of --shard runs.
+    """
+    calcs_obj = Calculations()
+    
+    if args.merge:
+        _print_arbs(calcs_obj, ShardedScan.merge([ShardedScan.load_results(filepath) for filepath in args.merge])['arbs'])
+        return
+    
+    cache_obj = _saved_cache()
+    last_scan = cache_obj.load_last_scan() if cache_obj is not None else None
+    if last_scan is None:
+        parser.error('No scan saved yet, run a scan first.')
+    
+    print('Scanned {0}.'.format(last_scan['scanned_at'].strftime('%Y-%m-%d %H:%M:%S')))
+    _print_arbs(calcs_obj, last_scan['arbs'])
+
+
+def scan(args: argparse.Namespace, parser: argparse.ArgumentParser) -> None:
+    """
+    Query IEX and Tradier for upcoming dividends and options chains, and find the arbs.
+    """
+    shard_index, shard_count = None, None
+    if args.shard:
+        try:
+            shard_index, shard_count = [int(i) for i in args.shard.split('/')]
+        except ValueError:
+            parser.error('--shard needs to look like 0/4.')
+        if not 0 <= shard_index < shard_count:
+            parser.error('--shard index has to be between 0 and {0}.'.format(shard_count - 1))
+        if args.incremental:
+            parser.error('--incremental keeps one snapshot of the whole universe, it can\'t be combined with --shard.')
+    #Ranking looks at every expiration from the record date on, so every chain has to be fetched.
+    expiration_window = None if args.rank else EXPIRATION_WINDOW
+    if args.shards > 1 and args.record_fixture:
+        parser.error('--record-fixture only sees the responses of this process, it can\'t be combined with --shards.')
+    if args.pipeline and (args.shards > 1 or args.rank or args.watch or args.stream):
+        parser.error('--pipeline drops chains once they\'re evaluated, it can\'t be combined with --shards, --rank, --watch or --stream.')
+    
+    calcs_obj = Calculations()
+    
+    #Grab api keys.
+    key_obj = APIKeys()
+    tradier_api_key = key_obj.tradier_key()
+    iex_key = key_obj.iexcloud_key()
+    
+    #Initialize objects.
+    cache_obj = CachedData()
+    #Recording has to see every response, so the clients skip the cache.
+    client_cache = None if args.record_fixture else cache_obj
+    dd_obj = DivvyData(iex_key, cache=client_cache)
+    opts_obj = OptionsData(tradier_api_key, cache=client_cache)
+    if shard_count:
+        opts_obj.ratelimiter = RateLimiter(share=args.budget_share or 1)
+        #Each shard only caches its own slice of the universe.
+        cache_obj.CACHED_DIVVIES_KEY += '-shard-{0}-of-{1}'.format(shard_index, shard_count)
+    
+    if args.base_url:
+        dd_obj.api = args.base_url + '{0}'
+        opts_obj.api = args.base_url + '{0}'
+        opts_obj.occ_url = args.base_url + '/infomemo-rss'
+    if args.record_fixture:
+        recorder = Recorder(args.record_fixture)
+        dd_obj.recorder = recorder
+        opts_obj.recorder = recorder
+    
+    #Check for cache first
+    divvies_with_exp = cache_obj.load() if client_cache else {}
+    snapshot = cache_obj.load_snapshot()
+    if args.incremental:
+        #Diff against the last scan, only new symbols get their expirations queried.
+        with _METRICS.stage('initial_divvy_query'):
+            raw_divvy_data = dd_obj.initial_divvy_query()
+        with _METRICS.stage('grab_quotes'):
+            quotes_dict = dd_obj.grab_quotes(raw_divvy_data)
+        with _METRICS.stage('refresh_expirations'):
+            divvies_with_exp = opts_obj.refresh_expirations(snapshot['divvies_with_exp'], quotes_dict=quotes_dict, raw_divvy_data=raw_divvy_data)
+        cache_obj.save(divvies_with_exp)
+    elif not divvies_with_exp:
+        #Grab dividend and quotes. This gets the initial list of future dividends
+        #and filters by lit exchanges.
+        with _METRICS.stage('initial_divvy_query'):
+            raw_divvy_data = dd_obj.initial_divvy_query()
+        
+        #Nodes only quote and discover expirations for their own shard.
+        if shard_count:
+            raw_divvy_data = ShardedScan.partition(raw_divvy_data, shard_count)[shard_index]
+        
+        #Grab quotes and options expirations, overlapped. Quotes filter out OTC symbols and
+        #expirations further filter by removing stocks with no options.
+        with _METRICS.stage('cold_start'):
+            quotes_dict, divvies_with_exp = asyncio.run(ColdStart(dd_obj, opts_obj).run(raw_divvy_data))
+        
+        #Cache.
+        cache_obj.save(divvies_with_exp)
+    
+    #Incremental scans only refetch chains for symbols where the arb is still possible.
+    prices = {}
+    if args.incremental:
+        with _METRICS.stage('recheck_quotes'):
+            prices = calcs_obj.last_prices(opts_obj.batch_quotes([k for k in divvies_with_exp.keys() if k in snapshot['headroom']]))
+        divvies_to_scan = calcs_obj.arb_still_possible(divvies_with_exp, snapshot['headroom'], prices)
+        _LOGGER.info('Refetching chains for {0} of {1} symbols.'.format(len(divvies_to_scan), len(divvies_with_exp)))
+    else:
+        divvies_to_scan = divvies_with_exp
+    
+    #Grab the RSS feed for OCC memos to filter out special divvies which end up as adjusted contracts and no arb.
+    with _METRICS.stage('get_occ_memos'):
+        occmemos = opts_obj.get_occ_memos()
+    
+    if args.shards > 1:
+        #Chains, yields, quotes and calculations in worker processes, merged back in symbol order.
+        sharded_obj = ShardedScan(
+            args.shards, tradier_api_key, iex_key, base_url=args.base_url, budget_share=args.budget_share, expiration_window=expiration_window
+        )
+        with _METRICS.stage('sharded_scan'):
+            fx_rates = dd_obj.fx_rates(dd_obj.foreign_currencies(divvies_to_scan))
+            merged = sharded_obj.run(divvies_to_scan, occmemos, fx_rates=fx_rates)
+        divvies_with_yield, current_arbs, scanned_headroom = merged['data'], merged['arbs'], merged['headroom']
+    elif args.pipeline:
+        #Chains, quotes, yields and arbs a batch at a time, trades go out to the sinks as they're found.
+        pipeline_obj = ScanPipeline(
+            dd_obj, opts_obj, calcs_obj, sinks=[LiveTableSink()] + _file_sinks(args),
+            store=SnapshotStore(args.history_dir) if args.history else None, expiration_window=expiration_window
+        )
+        with _METRICS.stage('pipeline'):
+            current_arbs, scanned_headroom = asyncio.run(pipeline_obj.run(divvies_to_scan, occmemos))
+        divvies_with_yield = None
+    else:
+        #Filtered down to symbols with options expirations, grab the chain data.
+        #Realtime quotes are grabbed right before the calculations instead.
+        with _METRICS.stage('grab_all_options_data'):
+            divvies_with_options = asyncio.run(opts_obj.grab_all_options_data_async(
+                divvies_to_scan, expiration_window=expiration_window, fetch_quotes=False
+            ))
+        
+        #Convert non USD currency divvies into USD.
+        with _METRICS.stage('currency_conversion'):
+            divvies_with_yield = dd_obj.currency_conversion(divvies_with_options)
+        
+        #Batched refresh of the realtime quotes so underlying asks are current.
+        with _METRICS.stage('refresh_quotes'):
+            opts_obj.refresh_quotes(divvies_with_yield)
+        
+        #Run calculations with data collected to find arbs.
+        with _METRICS.stage('find_arbs'), _METRICS.profile(args.profile, args.profile_output):
+            current_arbs = calcs_obj.find_arbs_vectorized(data = divvies_with_yield, occmemos = occmemos)
+        scanned_headroom = calcs_obj.headroom(data = divvies_with_yield, occmemos = occmemos)
+    
+    if args.history and not args.pipeline:
+        with _METRICS.stage('history'):
+            SnapshotStore(args.history_dir).append(divvies_with_yield)
+    
+    #The pipeline already wrote each trade as it was found.
+    if not args.pipeline:
+        sinks = _file_sinks(args)
+        try:
+            if current_arbs:
+                for sink in sinks:
+                    sink.write(current_arbs)
+        finally:
+            for sink in sinks:
+                sink.close()
+    
+    if shard_count:
+        #The snapshot covers the whole universe, nodes just hand their results over for merging.
+        ShardedScan.save_results(args.shard_output or SHARD_OUTPUT.format(shard_index, shard_count), current_arbs, scanned_headroom)
+    else:
+        #Remember how close each symbol got so the next incremental scan can skip hopeless ones.
+        headroom = {k: v for k, v in snapshot['headroom'].items() if k in divvies_with_exp and k not in divvies_to_scan}
+        #Prices as of the scan where the scan kept its realtime quotes, the --pipeline scan doesn't.
+        prices.update(calcs_obj.last_prices({k: v.get('realtime_quote') for k, v in (divvies_with_yield or {}).items()}))
+        headroom.update(calcs_obj.headroom_entries(scanned_headroom, divvies_to_scan, prices))
+        cache_obj.save_snapshot(divvies_with_exp, headroom)
+        #Everything the calculations saw, for rescore and show.
+        cache_obj.save_last_scan(divvies_with_yield, current_arbs)
+    
+    _METRICS.save(json_path=args.metrics_json, prometheus_path=args.metrics_prom)
+    if args.record_fixture:
+        recorder.save()
+    
+    _print_arbs(calcs_obj, current_arbs)
+    
+    if args.rank:
+        with _METRICS.stage('rank_opportunities'):
+            opportunities = calcs_obj.rank_opportunities(data=divvies_with_yield, occmemos=occmemos, top_k=args.rank, rank_by=args.rank_by)
+        if opportunities:
+            print('Top {0} long conversions across expirations by {1}:'.format(len(opportunities), args.rank_by))
+            print(columnar([list(opportunity.values()) for opportunity in opportunities], list(opportunities[0].keys()), no_borders=True, patterns=[]))
+    
+    if args.watch:
+        #Chains have to be fresh every poll, so the watcher gets its own uncached client.
+        watch_opts_obj = OptionsData(tradier_api_key)
+        watch_opts_obj.api = opts_obj.api
+        watch_opts_obj.ratelimiter = opts_obj.ratelimiter
+        Watcher(watch_opts_obj, calcs_obj, interval=args.interval, threshold=args.threshold).run(
+            data=divvies_with_yield, occmemos=occmemos, current_arbs=current_arbs
+        )
+    
+    if args.stream and current_arbs:
+        stream_obj = QuoteStream(opts_obj, calcs_obj, stream_url=args.stream_url, record_path=args.record)
+        symbols = stream_obj.track(data=divvies_with_yield, current_arbs=current_arbs)
+        print('Streaming quotes for {0} trades.'.format(len(stream_obj.tracked)))
+        try:
+            asyncio.run(stream_obj.run(
+                symbols,
+                on_change=lambda k, profit: print('{0} {1} strike ${2} profit ${3}'.format(strftime('%H:%M:%S'), k, stream_obj.tracked[k]['strike'], profit))
+            ))
+        except KeyboardInterrupt:
+            pass
+
+
+def main(argv: list = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+    #Plain divvycheck.py with scan flags still scans.
+    if not argv or argv[0] not in ('scan', 'rescore', 'show', '-h', '--help'):
+        argv = ['scan'] + argv
+    
+    parser = argparse.ArgumentParser(description='Find dividend arbitrage opportunities using underpriced puts.')
+    subparsers = parser.add_subparsers(dest='command')
+    
+    scan_parser = subparsers.add_parser('scan', help='Query the apis for dividends and chains and find arbs. The default.')
+    scan_parser.set_defaults(func=scan)
+    scan_parser.add_argument('--incremental', action='store_true', help='Only re-query symbols that changed since the last scan.')
+    scan_parser.add_argument('--watch', action='store_true', help='After the scan, keep polling symbols close to an arb and print changes.')
+    scan_parser.add_argument('--interval', type=float, default=WATCH_INTERVAL, help='Seconds between polls in watch mode.')
+    scan_parser.add_argument('--stream', action='store_true', help='After the scan, stream quotes for the trades found and reprint them as they reprice.')
+    scan_parser.add_argument('--record', help='With --stream, append the raw streamed messages to this file for replaying.')
+    scan_parser.add_argument('--stream-url', default=TRADIER_STREAM_URL, help='With --stream, the websocket to stream from, like a divvyreplay.py stream server. Defaults to {0}.'.format(TRADIER_STREAM_URL))
+    scan_parser.add_argument('--record-fixture', help='Record every api response into this gzipped fixture, see divvyreplay.py.')
+    scan_parser.add_argument('--base-url', help='Send every api request to this host instead, like a divvyreplay.py mock server.')
+    scan_parser.add_argument('--threshold', type=Decimal, default=WATCH_HEADROOM, help='Watch symbols whose best trade is within this many dollars of profitable.')
+    scan_parser.add_argument('--metrics-json', help='Write a json run report of stage timings and per endpoint request metrics to this file.')
+    scan_parser.add_argument('--metrics-prom', help='Write the same metrics in the Prometheus text format to this file.')
+    scan_parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'], help='Profile the calculation stage.')
+    scan_parser.add_argument('--profile-output', help='Write the profile to this file instead of printing it.')
+    scan_parser.add_argument('--shards', type=int, default=1, help='Split the chain sweep and calculations across this many worker processes.')
+    scan_parser.add_argument('--shard', help='Only scan shard i of n, like 0/4, for spreading a scan across hosts with their own api keys.')
+    scan_parser.add_argument('--shard-output', help='With --shard, where to write the results. Defaults to {0}.'.format(SHARD_OUTPUT.format('i', 'n')))
+    scan_parser.add_argument('--budget-share', type=float, help='Portion of the Tradier rate limit each shard uses. Defaults to 1/shards with --shards and all of it with --shard.')
+    scan_parser.add_argument('--rank', type=int, nargs='?', const=RANK_TOP_K, help='Also fetch every expiration after the record date and list the top {0} (or this many) trades across all of them.'.format(RANK_TOP_K))
+    scan_parser.add_argument('--rank-by', choices=['annualized', 'return', 'profit'], default='annualized', help='What --rank orders trades by.')
+    scan_parser.add_argument('--history', action='store_true', help='Append this scan\'s dividends, quotes and chains to the Parquet history. pip install pyarrow')
+    scan_parser.add_argument('--history-dir', default=HISTORY_DIRECTORY, help='Where the history is kept. Defaults to {0}.'.format(HISTORY_DIRECTORY))
+    scan_parser.add_argument('--pipeline', action='store_true', help='Evaluate symbols in small batches as their chains come in and print trades as they\'re found.')
+    scan_parser.add_argument('--jsonl', help='Append the trades found to this json lines file, as they\'re found with --pipeline.')
+    scan_parser.add_argument('--csv', help='Append the trades found to this csv file, as they\'re found with --pipeline.')
+    
+    rescore_parser = subparsers.add_parser('rescore', help='Rerun the calculations over the last scan\'s chains offline, with other fees and thresholds.')
+    rescore_parser.set_defaults(func=rescore)
+    rescore_parser.add_argument('--contract-cost', type=Decimal, default=Decimal(OPTION_CONTRACT_COST), help='Fee per contract action in dollars.')
+    rescore_parser.add_argument('--min-profit', type=Decimal, default=Decimal(0), help='Profit in dollars a trade has to beat to count.')
+    rescore_parser.add_argument('--history', action='store_true', help='Rescore every scan in the Parquet history instead. pip install pyarrow')
+    rescore_parser.add_argument('--history-dir', default=HISTORY_DIRECTORY, help='Where the history is kept. Defaults to {0}.'.format(HISTORY_DIRECTORY))
+    rescore_parser.add_argument('--since', help='With --history, the first scan date to include, like 2021-03-01.')
+    rescore_parser.add_argument('--until', help='With --history, the last scan date to include.')
+    
+    show_parser = subparsers.add_parser('show', help='Display the trades of the last scan.')
+    show_parser.set_defaults(func=show)
+    show_parser.add_argument('--merge', nargs='+', help='Merge the results of scan --shard runs and display them instead.')
+    
+    args = parser.parse_args(argv)
+    args.func(args, subparsers.choices[args.command])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""
+Local stand-ins for replaying recorded market data, so divvycheck.py can be
+run, tested and benchmarked without hitting the live APIs.
+
+HTTP replay: serves a fixture recorded with divvycheck.py --record-fixture. Point
+divvycheck.py at it with --base-url http://127.0.0.1:8766, or swap ReplayTransport in
+as the session of DivvyData/OptionsData to skip the sockets entirely.
+
+python divvyreplay.py http scan.jsonl.gz
+
+Stream replay: serves recorded Tradier streaming quotes (json lines, as written by
+divvycheck.py --stream --record) over a websocket. Point divvycheck.py at it with
+--stream --stream-url ws://127.0.0.1:8765/v1/markets/events.
+
+python divvyreplay.py stream recorded_quotes.jsonl
+"""
+
+import io
+import json
+import gzip
+import asyncio
+import argparse
+import logging
+import threading
+from time import time
+from urllib.parse import urlparse
+from collections import defaultdict
+from requests.structures import CaseInsensitiveDict
+#Local http and websocket servers. pip install aiohttp
+from aiohttp import web
+
+_LOGGER = logging.getLogger()
+_LOGGER.setLevel(logging.INFO)
+
+# constants
+REPLAY_HOST = '127.0.0.1'
+REPLAY_PORT = 8765
+REPLAY_HTTP_PORT = 8766
+REPLAY_DELAY = 0.01 #Seconds between replayed stream messages.
+RATELIMIT_WINDOW = 60 #Seconds, same as Tradier.
+IEX_BATCH_PATH = '/stable/stock/market/batch'
+TRADIER_QUOTES_PATH = '/v1/markets/quotes'
+BATCHED_QUOTE_PATHS = (IEX_BATCH_PATH, TRADIER_QUOTES_PATH)
+STREAM_SESSION_PATH = '/v1/markets/events/session'
+
+
+class Fixture(object):
+    def __init__(self, filepath: str = None, responses: list = None):
+        """
+        Recorded responses indexed by path and params. Hosts are ignored, the IEX, Tradier
+        and OCC paths don't overlap. Repeated requests get the recorded responses in order,
+        then the last one again.
+        
+        Quotes from batched IEX and Tradier quote responses are also indexed one symbol at a
+        time, so batches made up of different symbols than recorded can still be answered.
+        """
+        self.responses = defaultdict(list)
+        self.quotes = defaultdict(dict)
+        self._served = defaultdict(int)
+        
+        if filepath:
+            with gzip.open(filepath, 'rt', encoding='utf-8') as f:
+                responses = [json.loads(line) for line in f if line.strip()]
+        for response in responses or []:
+            self.add(response)
+    
+    def key(self, url: str, params: dict) -> tuple:
+        params = {k: str(v) for k, v in (params or {}).items() if k != 'token'}
+        
+        return urlparse(url).path, json.dumps(params, sort_keys=True)
+    
+    def add(self, response: dict) -> None:
+        path, params = self.key(response['url'], response['params'])
+        self.responses[(path, params)].append(response)
+        
+        if path in BATCHED_QUOTE_PATHS and response['status'] == 200:
+            for symbol, quote in self._split_quotes(path, json.loads(response['body'])).items():
+                self.quotes[path][symbol] = (quote, response['headers'])
+    
+    def _split_quotes(self, path: str, body) -> dict:
+        if path == IEX_BATCH_PATH:
+            return body or {}
+        
+        quotes = ((body or {}).get('quotes') or {}).get('quote') or []
+        if isinstance(quotes, dict):
+            quotes = [quotes]
+        
+        return {quote['symbol']: quote for quote in quotes}
+    
+    def _join_quotes(self, path: str, symbols: list) -> dict:
+        """
+        Build a batched quote response out of single symbol quotes, like the api would.
+        """
+        found = [symbol for symbol in symbols if symbol in self.quotes[path]]
+        if not found:
+            return None
+        
+        if path == IEX_BATCH_PATH:
+            body = {symbol: self.quotes[path][symbol][0] for symbol in found}
+        else:
+            quotes = [self.quotes[path][symbol][0] for symbol in found]
+            body = {'quotes': {'quote': quotes[0] if len(quotes) == 1 else quotes}}
+            unmatched = [symbol for symbol in symbols if symbol not in self.quotes[path]]
+            if unmatched:
+                body['quotes']['unmatched_symbols'] = {'symbol': unmatched}
+        
+        return {'status': 200, 'headers': self.quotes[path][found[-1]][1], 'body': json.dumps(body)}
+    
+    def lookup(self, url: str, params: dict) -> dict:
+        key = self.key(url, params)
+        responses = self.responses.get(key)
+        if not responses:
+            if key[0] in BATCHED_QUOTE_PATHS and params and params.get('symbols'):
+                return self._join_quotes(key[0], str(params['symbols']).split(','))
+            return None
+        
+        response = responses[min(self._served[key], len(responses) - 1)]
+        self._served[key] += 1
+        
+        return response
+    
+    def save(self, filepath: str) -> None:
+        with gzip.open(filepath, 'wt', encoding='utf-8') as f:
+            for responses in self.responses.values():
+                for response in responses:
+                    f.write(json.dumps(response) + '\n')
+
+
+class ReplayResponse(object):
+    def __init__(self, url: str, response: dict):
+        """
+        Just enough of requests.Response for the clients in divvycheck.py.
+        """
+        self.url = url
+        self.status_code = response['status']
+        self.headers = CaseInsensitiveDict(response['headers'])
+        self.text = response['body']
+        self.content = self.text.encode('utf-8')
+        #For streamed reads, like requests with stream=True.
+        self.raw = io.BytesIO(self.content)
+    
+    def __enter__(self) -> 'ReplayResponse':
+        return self
+    
+    def __exit__(self, *args) -> None:
+        return
+    
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+
+class ReplayTransport(object):
+    def __init__(self, fixture: Fixture):
+        """
+        Drop in replacement for the requests module as the session of DivvyData and OptionsData.
+        """
+        self.fixture = fixture
+        self.request_count = 0
+    
+    def request(self, method: str, url: str, params: dict = None, data: dict = None, **kwargs) -> ReplayResponse:
+        self.request_count += 1
+        response = self.fixture.lookup(url, params if method == 'GET' else data)
+        if response is None:
+            response = {'status': 404, 'headers': {}, 'body': 'null'}
+        
+        return ReplayResponse(url, response)
+    
+    def get(self, url: str, params: dict = None, **kwargs) -> ReplayResponse:
+        return self.request('GET', url, params=params)
+    
+    def post(self, url: str, data: dict = None, **kwargs) -> ReplayResponse:
+        return self.request('POST', url, data=data)
+
+
+class MockHTTPServer(object):
+    def __init__(self, fixture: Fixture, ratelimit_allowed: int = None, latency: float = 0):
+        """
+        Local http server answering from a fixture, standing in for IEX, Tradier and OCC at once.
+        
+        With ratelimit_allowed the recorded rate limit headers are replaced with a simulated
+        Tradier budget per window, including 429s once it runs out. latency adds a delay per request.
+        Counts requests and bytes served per path.
+        """
+        self.fixture = fixture
+        self.ratelimit_allowed = ratelimit_allowed
+        self.latency = latency
+        self.request_counts = defaultdict(int)
+        self.bytes_sent = 0
+        self._window_start = time()
+        self._window_used = 0
+    
+    def _ratelimit_headers(self) -> dict:
+        now = time()
+        if now - self._window_start >= RATELIMIT_WINDOW:
+            self._window_start = now
+            self._window_used = 0
+        self._window_used += 1
+        
+        return {
+            'X-Ratelimit-Allowed': str(self.ratelimit_allowed),
+            'X-Ratelimit-Used': str(self._window_used),
+            'X-Ratelimit-Available': str(max(self.ratelimit_allowed - self._window_used, 0)),
+            'X-Ratelimit-Expiry': str(int((self._window_start + RATELIMIT_WINDOW) * 1000))
+        }
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        params = dict(request.query)
+        if request.method == 'POST':
+            params.update(dict(await request.post()))
+        self.request_counts[request.path] += 1
+        
+        response = self.fixture.lookup(request.path, params)
+        #The stream server ignores the session id, so any will do when the fixture didn't record one.
+        if response is None and request.path == STREAM_SESSION_PATH:
+            return web.json_response({'stream': {'url': 'ws://{0}:{1}/v1/markets/events'.format(REPLAY_HOST, REPLAY_PORT), 'sessionid': 'replay'}})
+        if response is None:
+            return web.Response(status=404, text='null', content_type='application/json')
+        
+        headers = {k: v for k, v in response['headers'].items() if k.lower() != 'content-type'}
+        if self.ratelimit_allowed and request.path.startswith('/v1/markets'):
+            headers = self._ratelimit_headers()
+            if self._window_used > self.ratelimit_allowed:
+                return web.Response(status=429, text='Rate limit exceeded', headers=headers)
+        
+        body = response['body'].encode('utf-8')
+        self.bytes_sent += len(body)
+        content_type = response['headers'].get('Content-Type', response['headers'].get('content-type', 'application/json'))
+        
+        return web.Response(status=response['status'], body=body, headers=headers, content_type=content_type.split(';')[0])
+    
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self.handle)
+        
+        return app
+    
+    async def start(self, host: str = REPLAY_HOST, port: int = REPLAY_HTTP_PORT) -> web.AppRunner:
+        """
+        Start serving in the running event loop. Call cleanup() on the returned runner to stop.
+        """
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        
+        return runner
+    
+    def start_in_thread(self, host: str = REPLAY_HOST, port: int = REPLAY_HTTP_PORT) -> str:
+        """
+        Serve from a background thread, for driving blocking clients from the main thread.
+        
+        Returns the base url to point the clients at.
+        """
+        started = threading.Event()
+        
+        def serve():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start(host, port))
+            started.set()
+            loop.run_forever()
+        
+        threading.Thread(target=serve, daemon=True).start()
+        started.wait()
+        
+        return 'http://{0}:{1}'.format(host, port)
+
+
+class StreamReplayServer(object):
+    def __init__(self, messages_path: str, delay: float = REPLAY_DELAY):
+        """
+        Websocket server that behaves like the Tradier market events stream. Waits for the
+        subscription payload and then replays the recorded quotes for the subscribed symbols.
+        """
+        with open(messages_path, 'r') as f:
+            self.messages = [json.loads(line) for line in f if line.strip()]
+        self.delay = delay
+        self.subscriptions = []
+    
+    async def handle_stream(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        
+        subscription = await ws.receive_json()
+        self.subscriptions.append(subscription)
+        symbols = set(subscription.get('symbols', []))
+        
+        for message in self.messages:
+            if message.get('symbol') in symbols:
+                await ws.send_str(json.dumps(message) + '\n')
+                await asyncio.sleep(self.delay)
+        
+        await ws.close()
+        
+        return ws
+    
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/v1/markets/events', self.handle_stream)
+        
+        return app
+    
+    async def start(self, host: str = REPLAY_HOST, port: int = REPLAY_PORT) -> web.AppRunner:
+        """
+        Start serving in the running event loop. Call cleanup() on the returned runner to stop.
+        """
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        
+        return runner
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded market data locally.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    http_parser = subparsers.add_parser('http', help='Serve a recorded fixture over http.')
+    http_parser.add_argument('fixture_path', help='Gzipped fixture from divvycheck.py --record-fixture.')
+    http_parser.add_argument('--allowed', type=int, help='Simulate a Tradier rate limit of this many calls per minute.')
+    http_parser.add_argument('--latency', type=float, default=0, help='Seconds of delay added to every request.')
+    http_parser.add_argument('--host', default=REPLAY_HOST)
+    http_parser.add_argument('--port', type=int, default=REPLAY_HTTP_PORT)
+    stream_parser = subparsers.add_parser('stream', help='Replay recorded streaming quotes over a websocket.')
+    stream_parser.add_argument('messages_path', help='Json lines file of recorded stream messages.')
+    stream_parser.add_argument('--delay', type=float, default=REPLAY_DELAY, help='Seconds between messages.')
+    stream_parser.add_argument('--host', default=REPLAY_HOST)
+    stream_parser.add_argument('--port', type=int, default=REPLAY_PORT)
+    args = parser.parse_args()
+    
+    if args.command == 'http':
+        _LOGGER.info('Replaying {0} on http://{1}:{2}'.format(args.fixture_path, args.host, args.port))
+        server = MockHTTPServer(Fixture(args.fixture_path), ratelimit_allowed=args.allowed, latency=args.latency)
+        web.run_app(server.app(), host=args.host, port=args.port)
+    elif args.command == 'stream':
+        _LOGGER.info('Replaying stream on ws://{0}:{1}/v1/markets/events'.format(args.host, args.port))
+        web.run_app(StreamReplayServer(args.messages_path, delay=args.delay).app(), host=args.host, port=args.port)